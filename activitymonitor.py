@@ -0,0 +1,65 @@
+"""
+Detects activity of user containers from their resource usage. Initialize with ActivityMonitor(interval_in_seconds,
+clientsFunc, sampleFunc, activityFunc). When started, the monitor calls clientsFunc every interval_in_seconds seconds to
+get the names of the clients to watch, and sampleFunc with these names to get a dict mapping each name to a
+(cpu_nanoseconds, network_bytes) tuple of cumulative counters. If a client used more cpu or network than the thresholds
+since the previous sample, the monitor calls activityFunc with the client name as argument.
+"""
+
+import traceback
+from thread import start_new_thread
+from time import sleep, time
+from utils import sysout
+
+
+class ActivityMonitor(object):
+    def __init__(self, interval, clientsFunc, sampleFunc, activityFunc, cpuThreshold=0.05, netThreshold=8*1024):
+        """
+        :param cpuThreshold: cpu usage in cores (e.g. 0.05 = 5% of one core) that counts as activity
+        :param netThreshold: network traffic in bytes per second that counts as activity
+        """
+        self.interval = interval
+        self.clientsFunc = clientsFunc
+        self.sampleFunc = sampleFunc
+        self.activityFunc = activityFunc
+        self.cpuThreshold = cpuThreshold
+        self.netThreshold = netThreshold
+        self.samples = dict()
+
+    def start(self):
+        return start_new_thread(self.__monitor, ())
+
+    def check(self):
+        """
+        Samples all clients once and reports the active ones. Returns the names of the active clients.
+        """
+        names = self.clientsFunc()
+        samples = self.sampleFunc(names) if len(names) > 0 else {}
+        currenttime = time()
+        active = []
+        for name, (cpu, net) in samples.iteritems():
+            last = self.samples.get(name)
+            if last is not None and self.__is_active(currenttime - last[0], cpu - last[1], net - last[2]):
+                active.append(name)
+            self.samples[name] = (currenttime, cpu, net)
+        # forget clients that are no longer watched or could not be sampled
+        for name in self.samples.keys():
+            if name not in samples:
+                del self.samples[name]
+        for name in active:
+            self.activityFunc(name)
+        return active
+
+    def __is_active(self, elapsed, cpu, net):
+        if elapsed <= 0:
+            return False
+        return cpu / 1e9 / elapsed >= self.cpuThreshold or net / elapsed >= self.netThreshold
+
+    def __monitor(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.check()
+            except Exception, e:
+                sysout("Error in ActivityMonitor: " + str(e))
+                traceback.print_exc()
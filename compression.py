@@ -0,0 +1,129 @@
+"""
+Streaming compression for file transfers. CompressingWriter compresses everything written to it into a target stream,
+DecompressingReader decompresses a source stream while it is read. Both can be used as ends of a dockerio.Pump.
+
+DecompressingReader raises zlib.error for corrupt or truncated data and ValueError if the decompressed data exceeds its
+limit, so that a pump reading from it fails instead of writing partial data as if it were complete.
+
+CompressingWriter buffers the first SAMPLE_SIZE bytes before it writes anything. If the data is smaller than
+MIN_COMPRESS_SIZE, or compressing the sample does not save at least 10%, the data is written uncompressed and the
+writer's encoding is set to 'identity'.
+"""
+
+import zlib
+
+# window bits for zlib to write and read the supported encodings
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'zlib': zlib.MAX_WBITS}
+MIN_COMPRESS_SIZE = 1024
+SAMPLE_SIZE = 64 * 1024
+MAX_SAMPLE_RATIO = 0.9
+
+
+def choose_encoding(accepted):
+    """
+    Returns the first supported encoding of the accepted ones, or 'identity' if none is supported
+    :param accepted: list of encodings or comma separated string of encodings
+    """
+    if isinstance(accepted, basestring):
+        accepted = accepted.split(',')
+    for encoding in accepted or []:
+        if encoding.strip() in ENCODINGS:
+            return encoding.strip()
+    return 'identity'
+
+
+class CompressingWriter(object):
+    def __init__(self, target, encoding, level=6):
+        """
+        :param target: stream to write the (compressed) data to
+        :param encoding: one of ENCODINGS or 'identity'
+        :param level: zlib compression level
+        """
+        self.target = target
+        self.encoding = encoding
+        self.level = level
+        self.__compressor = None
+        self.__sample = []
+        self.__sampled = 0
+        self.__decided = encoding not in ENCODINGS
+
+    def write(self, data):
+        if not self.__decided:
+            self.__sample.append(data)
+            self.__sampled += len(data)
+            if self.__sampled >= SAMPLE_SIZE:
+                self.__decide()
+        elif self.__compressor is not None:
+            self.target.write(self.__compressor.compress(data))
+        else:
+            self.target.write(data)
+        return len(data)
+
+    def close(self):
+        """
+        Writes all remaining data to the target. Has to be called after the last write.
+        """
+        if not self.__decided:
+            self.__decide()
+        if self.__compressor is not None:
+            self.target.write(self.__compressor.flush())
+            self.__compressor = None
+
+    def __decide(self):
+        sample = ''.join(self.__sample)
+        self.__sample = None
+        self.__decided = True
+        if len(sample) < MIN_COMPRESS_SIZE or \
+                len(zlib.compress(sample[:SAMPLE_SIZE], 1)) > MAX_SAMPLE_RATIO * min(len(sample), SAMPLE_SIZE):
+            self.encoding = 'identity'
+            self.target.write(sample)
+            return
+        self.__compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[self.encoding])
+        self.target.write(self.__compressor.compress(sample))
+
+
+class DecompressingReader(object):
+    def __init__(self, source, encoding, limit=None):
+        """
+        :param source: stream to read compressed data from
+        :param encoding: one of ENCODINGS
+        :param limit: maximum number of decompressed bytes, None for no limit
+        """
+        self.source = source
+        self.encoding = encoding
+        self.limit = limit
+        self.__decompressor = zlib.decompressobj(ENCODINGS[encoding])
+        self.__length = 0
+
+    def read(self, n=4096):
+        """
+        Returns up to n bytes of decompressed data, or an empty string at the end of the stream
+        """
+        while True:
+            data = self.__decompressor.unconsumed_tail
+            if not data:
+                data = self.source.read(n)
+                if not data:
+                    if not self.__ended():
+                        raise zlib.error('Incomplete ' + self.encoding + ' data')
+                    return self.__count(self.__decompressor.flush())
+            result = self.__decompressor.decompress(data, n)
+            if result:
+                return self.__count(result)
+
+    def __count(self, result):
+        self.__length += len(result)
+        if self.limit is not None and self.__length > self.limit:
+            raise ValueError('Decompressed data exceeds ' + str(self.limit) + ' bytes')
+        return result
+
+    def __ended(self):
+        # zlib only reports the end of the stream by putting the data behind it into unused_data
+        if self.__decompressor.unused_data:
+            return True
+        probe = self.__decompressor.copy()
+        try:
+            probe.decompress('\0')
+        except zlib.error:
+            return False
+        return probe.unused_data != ''
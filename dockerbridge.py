@@ -7,22 +7,129 @@
     user input.
 """
 import base64
+import os
 import signal
 import sys
+import threading
+import time
 import StringIO
 
 import pyjsonrpc
 
-from dockermanager import DockerManager
-from filemanager import FileManager, absolute_userpath, data_container_name, lft_transferpath
+from activitymonitor import ActivityMonitor
+from compression import CompressingWriter, DecompressingReader, ENCODINGS, choose_encoding
+from filemanager import absolute_userpath, data_container_name, lft_transferpath
+from hostrouter import DockerHost, HostRouter, parse_hosts
+from secretcache import SecretCache
+from sessionstore import SessionStore
 from securitycheck import *
 from timeoutmanager import TimeoutManager
-from utils import sysout
+from utils import sysout, run_parallel, STATE_DIR
+
+# Sessions without refresh are paused after IDLE_PAUSE seconds and stopped after IDLE_STOP seconds. Container activity
+# counts as refresh, it is sampled every ACTIVITY_INTERVAL seconds.
+IDLE_PAUSE = 120
+IDLE_STOP = 300
+ACTIVITY_INTERVAL = 30
+# Maximum number of seconds a wait_until_ready request may block
+MAX_READY_WAIT = 120
+# Maximum number of bytes returned by a single range, tail or follow read
+MAX_READ_LENGTH = 1024 * 1024
+# Maximum number of bytes a compressed upload may decompress to
+MAX_DECOMPRESSED_LENGTH = 64 * 1024 * 1024
+# What to do with the running sessions on SIGTERM/SIGINT: 'persist' writes their exact timeouts to the session store
+# to restore them on the next start, 'stop' stops all sessions
+SHUTDOWN_MODE = os.environ.get('DOCKERBRIDGE_SHUTDOWN', 'persist')
+SHUTDOWN_PARALLELISM = 16
+SESSION_STORE = os.path.join(STATE_DIR, 'sessions.db')
+# Seconds a cached rosauth secret stays valid, None to keep it until the data container is removed
+SECRET_CACHE_TTL = None
+# Paused sessions are stopped early while less than this fraction of the host memory is available
+MIN_AVAILABLE_MEMORY = 0.15
 
 
 def to_deb64_stream(data):
     return StringIO.StringIO(base64.b64decode(data))
 
+
+def dockermanager(user_name):
+    return router.host(user_name).dockermanager
+
+
+def filemanager(user_name):
+    return router.host(user_name).filemanager
+
+
+def transfers(user_name):
+    return router.host(user_name).transfers
+
+
+def stop_sessions(user_names, parallelism):
+    """
+    Stops the sessions of the given users concurrently, with at most parallelism sessions at the same time.
+    Returns a dict with the lists of stopped and failed users and the seconds it took.
+    """
+    start = time.time()
+    progress = {'done': 0}
+    lock = threading.Lock()
+
+    def stop(user_name):
+        stopped = False
+        try:
+            stopped = dockermanager(user_name).stop_user_container(user_name)
+            return stopped
+        finally:
+            # failed sessions keep their timeout, so the watchdog retries to stop them
+            if stopped is True:
+                timeout.remove(user_name)
+            with lock:
+                progress['done'] += 1
+                sysout('Stopped ' + str(progress['done']) + '/' + str(len(user_names)) + ' sessions')
+
+    results = run_parallel(stop, user_names, parallelism)
+    stopped = sorted(user_name for user_name, result in results.iteritems() if result is True)
+    return {'stopped': stopped,
+            'failed': sorted(user_name for user_name in results if user_name not in stopped),
+            'seconds': time.time() - start}
+
+
+def all_sessions():
+    """
+    Returns the users with a timeout or a running knowrob container on any host
+    """
+    user_names = set(timeout.clients.keys())
+    for running in run_parallel(lambda host: host.dockermanager.running_users(), router.hosts).values():
+        if isinstance(running, Exception):
+            sysout('Error listing sessions: ' + str(running))
+        else:
+            user_names.update(running)
+    return sorted(user_names)
+
+
+def reconcile_sessions():
+    """
+    Restores the stored timeouts of the sessions that are still running, forgets the stored sessions that are gone and
+    stops the running sessions without stored timeout, as they would never expire otherwise.
+    """
+    stored = store.load()
+    running = set()
+    for host, user_names in run_parallel(lambda host: host.dockermanager.running_users(), router.hosts).iteritems():
+        if isinstance(user_names, Exception):
+            sysout('Error listing sessions on docker host ' + host.name + ': ' + str(user_names) +
+                   ', restoring all stored sessions')
+            timeout.restore(stored)
+            return
+        running.update(user_names)
+    timeout.restore(dict((name, entry) for name, entry in stored.iteritems() if name in running))
+    for name in stored:
+        if name not in running:
+            store.remove(name)
+    orphans = sorted(running.difference(stored))
+    if len(orphans) > 0:
+        sysout('Stopping ' + str(len(orphans)) + ' orphaned sessions')
+        stop_sessions(orphans, SHUTDOWN_PARALLELISM)
+
+
 class DockerBridge(pyjsonrpc.HttpRequestHandler):
 
     @pyjsonrpc.rpcmethod
@@ -33,90 +140,217 @@ class DockerBridge(pyjsonrpc.HttpRequestHandler):
         check_containername(knowrob_image, 'container_name')
         #check_containername(neem_version, 'container_name')
         #check_containername(knowrob_version, 'container_name')
-        dockermanager.start_user_container(user_name, neemHubSettings, knowrob_image, knowrob_version)
-        timeout.setTimeout(user_name, 600)
+        dockermanager(user_name).start_user_container(user_name, neemHubSettings, knowrob_image, knowrob_version)
+        timeout.setTimeout(user_name, IDLE_STOP, IDLE_PAUSE)
 
     @pyjsonrpc.rpcmethod
     def create_user_data_container(self, user_name):
         check_containername(user_name, 'container_name')
-        dockermanager.create_user_data_container(user_name)
+        dockermanager(user_name).create_user_data_container(user_name)
 
     @pyjsonrpc.rpcmethod
     def stop_user_container(self, user_name):
         check_containername(user_name, 'user_container_name')
-        dockermanager.stop_user_container(user_name)
+        dockermanager(user_name).stop_user_container(user_name)
         timeout.remove(user_name)
 
     @pyjsonrpc.rpcmethod
     def container_started(self, user_name):
         check_containername(user_name, 'user_container_name')
-        return dockermanager.container_started(user_name)
+        return dockermanager(user_name).container_started(user_name)
 
     @pyjsonrpc.rpcmethod
     def get_container_ip(self, user_name):
         check_containername(user_name, 'user_container_name')
-        return dockermanager.get_container_ip(user_name)
+        return dockermanager(user_name).get_container_ip(user_name)
+
+    @pyjsonrpc.rpcmethod
+    def wait_until_ready(self, user_name, timeout=60):
+        check_containername(user_name, 'user_container_name')
+        result = router.host(user_name).readiness.wait(user_name, min(float(timeout), MAX_READY_WAIT))
+        if result is None:
+            return {'ready': False}
+        return {'ready': True, 'ip': result['ip'], 'time_to_ready': result['time_to_ready']}
 
     @pyjsonrpc.rpcmethod
     def refresh(self, user_name):
         check_containername(user_name, 'user_container_name')
-        timeout.resetTimeout(user_name, 600)
+        timeout.resetTimeout(user_name, IDLE_STOP, IDLE_PAUSE)
+
+    @pyjsonrpc.rpcmethod
+    def stop_user_containers(self, user_names=None, parallelism=8):
+        if user_names is None:
+            user_names = all_sessions()
+        for user_name in user_names:
+            check_containername(user_name, 'user_container_name')
+        return stop_sessions(user_names, max(1, min(check_count(parallelism, 'parallelism'), 64)))
 
     @pyjsonrpc.rpcmethod
-    def files_fromcontainer(self, user_name, sourcefile):
+    def hosts_status(self):
+        status = []
+        for host in router.hosts:
+            entry = {'name': host.name, 'url': host.url, 'draining': host.draining,
+                     'users': len(router.users(host))}
+            try:
+                entry.update(host.load())
+            except Exception, e:
+                entry['error'] = str(e)
+            status.append(entry)
+        return status
+
+    @pyjsonrpc.rpcmethod
+    def hosts_drain(self, name, draining=True):
+        host = router.by_name(name)
+        if host is None:
+            raise SecurityException('Unknown docker host ' + name)
+        host.draining = bool(draining)
+        sysout(('Draining' if host.draining else 'Undraining') + ' docker host ' + host.name)
+
+    @pyjsonrpc.rpcmethod
+    def files_fromcontainer(self, user_name, sourcefile, accept_encoding=None):
         check_containername(user_name, 'user_container_name')
         check_pathname(sourcefile, 'sourcefile')
 
         container = data_container_name(user_name)
         file = absolute_userpath(sourcefile)
         data = StringIO.StringIO()
-        filemanager.fromcontainer(container, file, data)
-        return base64.b64encode(data.getvalue())
+        if accept_encoding is None:
+            filemanager(user_name).fromcontainer(container, file, data)
+            return base64.b64encode(data.getvalue())
+        # The client negotiates compression, the answer tells which encoding was actually used
+        writer = CompressingWriter(data, choose_encoding(accept_encoding))
+        filemanager(user_name).fromcontainer(container, file, writer)
+        writer.close()
+        return {'encoding': writer.encoding, 'data': base64.b64encode(data.getvalue())}
 
     @pyjsonrpc.rpcmethod
-    def files_tocontainer(self, user_name, data, targetfile):
+    def files_tocontainer(self, user_name, data, targetfile, encoding='identity'):
         check_containername(user_name, 'user_container_name')
         check_pathname(targetfile, 'targetfile')
 
         container = data_container_name(user_name)
         file = absolute_userpath(targetfile)
-        filemanager.tocontainer(container, to_deb64_stream(data), file, 1000)
+        source = to_deb64_stream(data)
+        if encoding in ENCODINGS:
+            # corrupt, truncated or too large data fails the write before the target file is replaced
+            source = DecompressingReader(source, encoding, MAX_DECOMPRESSED_LENGTH)
+        elif encoding != 'identity':
+            raise ValueError('Unsupported encoding ' + encoding)
+        filemanager(user_name).tocontainer(container, source, file, 1000)
+
+    @pyjsonrpc.rpcmethod
+    def files_read_range(self, user_name, sourcefile, offset, length):
+        check_containername(user_name, 'user_container_name')
+        check_pathname(sourcefile, 'sourcefile')
+        offset = check_count(offset, 'offset')
+        length = min(check_count(length, 'length'), MAX_READ_LENGTH)
+
+        container = data_container_name(user_name)
+        result = filemanager(user_name).readrange(container, absolute_userpath(sourcefile), offset, length)
+        if result is None:
+            return None
+        size, data = result
+        return {'data': base64.b64encode(data), 'offset': offset, 'size': size, 'eof': offset + len(data) >= size}
+
+    @pyjsonrpc.rpcmethod
+    def files_tail(self, user_name, sourcefile, count=10, lines=True):
+        check_containername(user_name, 'user_container_name')
+        check_pathname(sourcefile, 'sourcefile')
+        count = check_count(count, 'count')
+        if not lines:
+            count = min(count, MAX_READ_LENGTH)
+
+        container = data_container_name(user_name)
+        # lines may be longer than wanted, only the last MAX_READ_LENGTH bytes are read
+        result = filemanager(user_name).tail(container, absolute_userpath(sourcefile), count, bool(lines),
+                                             MAX_READ_LENGTH)
+        if result is None:
+            return None
+        size, data = result
+        return {'data': base64.b64encode(data), 'offset': size - len(data), 'size': size, 'cursor': size}
+
+    @pyjsonrpc.rpcmethod
+    def files_follow(self, user_name, sourcefile, cursor):
+        check_containername(user_name, 'user_container_name')
+        check_pathname(sourcefile, 'sourcefile')
+        cursor = check_count(cursor, 'cursor')
+
+        container = data_container_name(user_name)
+        file = absolute_userpath(sourcefile)
+        result = filemanager(user_name).readrange(container, file, cursor, MAX_READ_LENGTH)
+        truncated = result is not None and result[0] < cursor
+        if truncated:
+            # The file was truncated or replaced, follow it from the beginning
+            cursor = 0
+            result = filemanager(user_name).readrange(container, file, cursor, MAX_READ_LENGTH)
+        if result is None:
+            return None
+        size, data = result
+        return {'data': base64.b64encode(data), 'offset': cursor, 'size': size, 'cursor': cursor + len(data),
+                'truncated': truncated}
 
     @pyjsonrpc.rpcmethod
     def files_lft_set_writeable(self):
-        filemanager.chown_lft(1000, 1000)
+        for host in router.hosts:
+            host.filemanager.chown_lft(1000, 1000)
 
     @pyjsonrpc.rpcmethod
-    def files_largefromcontainer(self, user_name, sourcefile, targetfile):
+    def files_largefromcontainer(self, user_name, sourcefile, targetfile, sync=False, checksum=False, delete=False,
+                                 resumable=False):
         check_pathname(sourcefile, 'sourcefile')
         check_pathname(targetfile, 'targetfile')
 
         file = absolute_userpath(sourcefile)
         target = lft_transferpath(targetfile)
-        self.__largecopy(user_name, file, target)
+        return self.__largecopy(user_name, file, target, sync, checksum, delete, resumable)
 
     @pyjsonrpc.rpcmethod
-    def files_largetocontainer(self, user_name, sourcefile, targetfile):
+    def files_largetocontainer(self, user_name, sourcefile, targetfile, sync=False, checksum=False, delete=False,
+                               resumable=False):
         check_pathname(sourcefile, 'sourcefile')
         check_pathname(targetfile, 'targetfile')
 
         file = lft_transferpath(sourcefile)
         target = absolute_userpath(targetfile)
-        self.__largecopy(user_name, file, target)
+        return self.__largecopy(user_name, file, target, sync, checksum, delete, resumable)
+
+    @pyjsonrpc.rpcmethod
+    def files_transfer_status(self, user_name, job):
+        check_containername(user_name, 'user_container_name')
+        check_containername(job, 'job')
+
+        return transfers(user_name).status(data_container_name(user_name), job)
 
-    def __largecopy(self, user_name, src, tgt):
+    @pyjsonrpc.rpcmethod
+    def files_transfer_cancel(self, user_name, job):
+        check_containername(user_name, 'user_container_name')
+        check_containername(job, 'job')
+
+        transfers(user_name).cancel(data_container_name(user_name), job)
+
+    def __largecopy(self, user_name, src, tgt, sync=False, checksum=False, delete=False, resumable=False):
         check_containername(user_name, 'user_container_name')
 
         container = data_container_name(user_name)
-        filemanager.copy_with_lft(container, src, tgt, 1000)
+        if resumable:
+            return transfers(user_name).transfer(container, src, tgt, 1000)
+        if sync:
+            return filemanager(user_name).sync_with_lft(container, src, tgt, 1000, bool(checksum), bool(delete))
+        filemanager(user_name).copy_with_lft(container, src, tgt, 1000)
 
     @pyjsonrpc.rpcmethod
     def files_readsecret(self, user_name):
         check_containername(user_name, 'user_container_name')
 
         container = data_container_name(user_name)
+        secret = secrets.get(container)
+        if secret is not None:
+            return secret
+        token = secrets.begin(container)
         data = StringIO.StringIO()
-        filemanager.fromcontainer(container, '/etc/rosauth/secret', data)
+        filemanager(user_name).fromcontainer(container, '/etc/rosauth/secret', data)
+        if data.getvalue():
+            secrets.fill(container, token, data.getvalue())
         return data.getvalue()
 
     @pyjsonrpc.rpcmethod
@@ -124,8 +358,12 @@ class DockerBridge(pyjsonrpc.HttpRequestHandler):
         check_containername(user_name, 'user_container_name')
 
         container = data_container_name(user_name)
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
         data = StringIO.StringIO(secret)
-        filemanager.tocontainer(container, data, '/etc/rosauth/secret')
+        secrets.invalidate(container)
+        filemanager(user_name).tocontainer(container, data, '/etc/rosauth/secret')
+        secrets.put(container, secret)
 
     @pyjsonrpc.rpcmethod
     def files_exists(self, user_name, file):
@@ -134,7 +372,7 @@ class DockerBridge(pyjsonrpc.HttpRequestHandler):
 
         container = data_container_name(user_name)
         checkexisting = absolute_userpath(file)
-        return filemanager.exists(container, checkexisting)
+        return filemanager(user_name).exists(container, checkexisting)
 
     @pyjsonrpc.rpcmethod
     def files_mkdir(self, user_name, dir):
@@ -143,7 +381,7 @@ class DockerBridge(pyjsonrpc.HttpRequestHandler):
 
         container = data_container_name(user_name)
         file = absolute_userpath(dir)
-        filemanager.mkdir(container, file, True, 1000)
+        filemanager(user_name).mkdir(container, file, True, 1000)
 
     @pyjsonrpc.rpcmethod
     def files_rm(self, user_name, file, recursive=False):
@@ -152,7 +390,7 @@ class DockerBridge(pyjsonrpc.HttpRequestHandler):
 
         container = data_container_name(user_name)
         filetorm = absolute_userpath(file)
-        filemanager.rm(container, filetorm, recursive)
+        filemanager(user_name).rm(container, filetorm, recursive)
 
     @pyjsonrpc.rpcmethod
     def files_ls(self, user_name, dir, recursive=False):
@@ -161,22 +399,103 @@ class DockerBridge(pyjsonrpc.HttpRequestHandler):
 
         container = data_container_name(user_name)
         file = absolute_userpath(dir)
-        return filemanager.listfiles(container, file, recursive)
+        return filemanager(user_name).listfiles(container, file, recursive)
 
 
 def handler(signum, frame):
+    if SHUTDOWN_MODE == 'stop':
+        sysout('Shutting down, stopping all sessions')
+        stop_sessions(all_sessions(), SHUTDOWN_PARALLELISM)
+    elif SHUTDOWN_MODE == 'persist':
+        sysout('Shutting down, saving session timeouts')
+        timeout.flush()
     sys.exit(0)
 
 signal.signal(signal.SIGTERM, handler)
 signal.signal(signal.SIGINT, handler)
 
-dockermanager = DockerManager()
-filemanager = FileManager()
+# Docker endpoints to distribute the users across, as comma separated list of url or name=url entries
+hosts = [DockerHost(name, url, STATE_DIR) for name, url in parse_hosts(os.environ.get('DOCKERBRIDGE_HOSTS'))]
+router = HostRouter(hosts)
+
+secrets = SecretCache(SECRET_CACHE_TTL)
+
+
+def invalidate_secret(action, container_name):
+    if action == 'reset':
+        secrets.clear()
+    elif action == 'destroy':
+        secrets.invalidate(container_name)
+
+sysout("Starting docker event listeners")
+for host in hosts:
+    host.dockermanager.add_event_listener(invalidate_secret)
+    host.dockermanager.watch_events()
+
+
+store = SessionStore(SESSION_STORE)
+
+
+def watched_host(user_name):
+    """
+    Returns the host of a user tracked by the watchdog, or None if it can not be resolved now, e.g. while a docker host
+    is unreachable. The watchdog skips such users until its next check.
+    """
+    try:
+        return router.host(user_name)
+    except Exception, e:
+        sysout("Can not resolve the docker host of " + user_name + ": " + str(e))
+        return None
+
+
+def sample_activity(user_names):
+    groups = {}
+    for user_name in user_names:
+        host = watched_host(user_name)
+        if host is not None:
+            groups.setdefault(host, []).append(user_name)
+    samples = {}
+    # run_parallel needs hashable items, so it gets the hosts and looks up their users
+    for result in run_parallel(lambda host: host.dockermanager.sample_activity(groups[host]), groups.keys()).values():
+        if not isinstance(result, Exception):
+            samples.update(result)
+    return samples
+
+
+def stop_timed_out(user_name):
+    host = watched_host(user_name)
+    if host is None:
+        return False
+    host.dockermanager.stop_user_container(user_name)
+
+
+def pause_idle(user_name):
+    host = watched_host(user_name)
+    if host is None:
+        return None
+    return host.dockermanager.pause_user_container(user_name)
+
+
+def resume_refreshed(user_name):
+    host = watched_host(user_name)
+    return host is not None and host.dockermanager.unpause_user_container(user_name)
+
+
+def memory_pressure(user_name):
+    host = watched_host(user_name)
+    return host is not None and host.memory_pressure(MIN_AVAILABLE_MEMORY)
 
 sysout("Starting watchdog")
-timeout = TimeoutManager(5, dockermanager.stop_user_container)
+timeout = TimeoutManager(5, stop_timed_out, pauseFunc=pause_idle, resumeFunc=resume_refreshed,
+                         pressureFunc=memory_pressure, store=store)
+reconcile_sessions()
 timeout.start()
 
+sysout("Starting activity monitor")
+activity = ActivityMonitor(ACTIVITY_INTERVAL, timeout.activeClients, sample_activity,
+                           lambda user_name: timeout.resetTimeout(user_name, IDLE_STOP, IDLE_PAUSE))
+activity.start()
+
 http_server = pyjsonrpc.ThreadingHttpServer(
     server_address=('0.0.0.0', 5001),
     RequestHandlerClass=DockerBridge
@@ -5,19 +5,39 @@ with the docker host.
 import os
 import traceback
 import json
+import calendar
+from thread import start_new_thread
+from time import sleep, strptime
 import docker
 from docker.errors import *
 from filemanager import data_container_name, knowrob_container_name, mongo_container_name, user_network_name, absolute_userpath
+from lifecyclecoordinator import LifecycleCoordinator
+from sessioncache import SessionCache
 
-from utils import sysout
+from utils import sysout, run_parallel
 
+DOCKER_URL='unix://var/run/docker.sock'
 USER_DATA_IMAGE='knowrob/user_data'
+# memory limit of resource limited knowrob containers
+KNOWROB_MEM_LIMIT=256 * 1024 * 1024
 # TODO: make configurable
 KNOWROB_IMAGE_PREFIX='openease'
 
 class DockerManager(object):
-    def __init__(self):
-        self.__client = docker.Client(base_url='unix://var/run/docker.sock',
+    """
+    Lifecycle operations (start, stop, pause, ...) are coordinated per user: concurrent identical requests for a user
+    are merged into one operation, other requests for the same user are executed one after another.
+
+    The state of the knowrob containers is cached and kept up to date by the manager's own lifecycle operations and by
+    docker events. The cache is only used while the event stream started with watch_events() is connected.
+    """
+    def __init__(self, base_url=DOCKER_URL):
+        self.base_url = base_url
+        self.__lifecycle = LifecycleCoordinator()
+        self.__sessions = SessionCache()
+        self.__events_connected = False
+        self.__event_listeners = []
+        self.__client = docker.Client(base_url=base_url,
                                       version='1.22',
                                       timeout=60)
         try:
@@ -27,8 +47,17 @@ class DockerManager(object):
             traceback.print_exc()
     
     def start_user_container(self, user_name, neemHubSettings, knowrob_image, knowrob_version):
+        return self.__lifecycle.run(user_name, ('start', neemHubSettings, knowrob_image, knowrob_version),
+                                    self.__start_user_container__,
+                                    user_name, neemHubSettings, knowrob_image, knowrob_version)
+
+    def __start_user_container__(self, user_name, neemHubSettings, knowrob_image, knowrob_version):
         try:
             all_containers = self.__client.containers(all=True)
+            # Resume a paused session instead of a cold start if it was started with the same settings
+            if self.__resume_user_container__(user_name, neemHubSettings, all_containers):
+                self.__sessions.update(user_name, running=True)
+                return
             # Stop user container if running
             self.__stop_user_container__(user_name, all_containers)
             # make sure the image is locally available
@@ -43,11 +72,17 @@ class DockerManager(object):
             self.__create_user_data_container__(user_name,all_containers)
             self.__create_user_network__(user_name)
             self.__create_knowrob_container__(user_name,neemHubSettings,knowrob_image,knowrob_version)
+            inspect = self.__client.inspect_container(knowrob_container_name(user_name))
+            self.__sessions.update(user_name, **self.__session_state(inspect))
         except Exception, e:
+            self.__sessions.invalidate(user_name)
             sysout("Error in start_user_container: " + str(e.message))
             traceback.print_exc()
 
     def create_user_data_container(self, user_name):
+        return self.__lifecycle.run(user_name, ('create_data',), self.__create_data_container__, user_name)
+
+    def __create_data_container__(self, user_name):
         try:
             all_containers = self.__client.containers(all=True)
             self.__create_user_data_container__(user_name, all_containers)
@@ -82,28 +117,45 @@ class DockerManager(object):
             # TODO: start needed for volume? will exit right away, or not?
             self.__client.start(user_data_container)
 
+    @staticmethod
+    def __knowrob_env__(user_name, neemHubSettings):
+        knowrob_container = knowrob_container_name(user_name)
+        parsed_json_neemHubSettings = (json.loads(neemHubSettings))
+
+        return {"VIRTUAL_HOST": knowrob_container,
+                "VIRTUAL_PORT": '9090',
+                "KNOWROB_MONGO_USER": parsed_json_neemHubSettings['mongo_user'],
+                "KNOWROB_MONGO_PASS": parsed_json_neemHubSettings['mongo_pass'],
+                "KNOWROB_MONGO_DB": parsed_json_neemHubSettings['mongo_db'],
+                "KNOWROB_MONGO_HOST": parsed_json_neemHubSettings['mongo_host'],
+                "KNOWROB_MONGO_PORT": parsed_json_neemHubSettings['mongo_port'],
+                "KNOWROB_URDF_SERVER": parsed_json_neemHubSettings['urdf_server']
+        }
+
+    def __resume_user_container__(self, user_name, neemHubSettings, all_containers):
+        knowrob_container = knowrob_container_name(user_name)
+        if not self.__is_paused(self.__get_container(knowrob_container, all_containers)):
+            return False
+        env = self.__knowrob_env__(user_name, neemHubSettings)
+        container_env = self.__client.inspect_container(knowrob_container)['Config']['Env'] or []
+        if not all(key + '=' + str(value) in container_env for key, value in env.iteritems()):
+            return False
+        sysout("Resuming paused user container " + knowrob_container)
+        self.__client.unpause(knowrob_container)
+        return True
+
     def __create_knowrob_container__(self, user_name, neemHubSettings, knowrob_image, knowrob_version):
         knowrob_container = knowrob_container_name(user_name)
         network_name = user_network_name(user_name)
         user_home_dir = absolute_userpath('')
 
         sysout("Creating user container " + knowrob_container)
-        parsed_json_neemHubSettings = (json.loads(neemHubSettings))
-
-        env = {"VIRTUAL_HOST": knowrob_container,
-               "VIRTUAL_PORT": '9090',
-               "KNOWROB_MONGO_USER": parsed_json_neemHubSettings['mongo_user'],
-               "KNOWROB_MONGO_PASS": parsed_json_neemHubSettings['mongo_pass'],
-               "KNOWROB_MONGO_DB": parsed_json_neemHubSettings['mongo_db'],
-               "KNOWROB_MONGO_HOST": parsed_json_neemHubSettings['mongo_host'],
-               "KNOWROB_MONGO_PORT": parsed_json_neemHubSettings['mongo_port'],
-               "KNOWROB_URDF_SERVER": parsed_json_neemHubSettings['urdf_server']
-        }
+        env = self.__knowrob_env__(user_name, neemHubSettings)
 
         # TODO: make this configurable based on the roles of the user
         limit_resources = True
         if limit_resources:
-            mem_limit = 256 * 1024 * 1024
+            mem_limit = KNOWROB_MEM_LIMIT
             # default is 1024, meaning that 4 of these containers will receive the same cpu time as one default
             # container. decrease this further if you want to increase the maximum amount of users on the host.
             cpu_shares = 256
@@ -137,39 +189,227 @@ class DockerManager(object):
                             volumes_from=volumes_from)
 
     def stop_user_container(self, user_name):
+        """
+        Stops and removes the knowrob container of the given user. Returns True if no error occurred.
+        """
+        return self.__lifecycle.run(user_name, ('stop',), self.__stop_user_container_safe__, user_name)
+
+    def __stop_user_container_safe__(self, user_name):
         try:
             self.__stop_user_container__(user_name, self.__client.containers(all=True))
+            return True
         except (APIError, DockerException), e:
             sysout("Error in stop_user_container: " + str(e.message))
-    
+        return False
+
+    def pause_user_container(self, user_name):
+        """
+        Freezes the knowrob container of the given user. Returns True if the container was paused.
+        """
+        return self.__lifecycle.run(user_name, ('pause',), self.__pause_user_container__, user_name)
+
+    def __pause_user_container__(self, user_name):
+        try:
+            sysout("Pausing container " + knowrob_container_name(user_name) + "...")
+            self.__client.pause(knowrob_container_name(user_name))
+            return True
+        except (APIError, DockerException), e:
+            sysout("Error in pause_user_container: " + str(e.message))
+        return False
+
+    def unpause_user_container(self, user_name):
+        """
+        Resumes the frozen knowrob container of the given user. Returns True if the container was unpaused.
+        """
+        return self.__lifecycle.run(user_name, ('unpause',), self.__unpause_user_container__, user_name)
+
+    def __unpause_user_container__(self, user_name):
+        try:
+            sysout("Unpausing container " + knowrob_container_name(user_name) + "...")
+            self.__client.unpause(knowrob_container_name(user_name))
+            return True
+        except (APIError, DockerException), e:
+            sysout("Error in unpause_user_container: " + str(e.message))
+        return False
+
     def __stop_user_container__(self, user_name, all_containers):
         self.__stop_container__(knowrob_container_name(user_name), all_containers)
         self.__stop_container__(mongo_container_name(user_name), all_containers)
+        self.__sessions.update(user_name, running=False, ip=None)
         self.__remove_user_network__(user_name)
 
     def __stop_container__(self, container_name, all_containers):
         # check if containers exist:
-        if self.__get_container(container_name, all_containers) is not None:
+        container = self.__get_container(container_name, all_containers)
+        if container is not None:
+            # paused containers can not be stopped
+            if self.__is_paused(container):
+                self.__client.unpause(container_name)
             sysout("Stopping container " + container_name + "...")
             self.__client.stop(container_name, timeout=5)
             sysout("Removing container " + container_name + "...")
             self.__client.remove_container(container_name)
 
+    def sample_activity(self, user_names, parallelism=8):
+        """
+        Reads the cumulative cpu and network counters of the knowrob containers of the given users. The stats requests
+        are sent concurrently, as docker takes about a second to collect each of them.
+        :return: a dict mapping each user name to a (cpu_nanoseconds, network_bytes) tuple. Users whose container could
+        not be sampled are left out.
+        """
+        stats = run_parallel(lambda user_name: self.__client.stats(knowrob_container_name(user_name), stream=False),
+                             user_names, parallelism)
+        samples = {}
+        for user_name, stat in stats.iteritems():
+            if isinstance(stat, Exception):
+                sysout("Error in sample_activity: " + str(stat))
+                continue
+            try:
+                cpu = stat['cpu_stats']['cpu_usage']['total_usage']
+                net = sum(n['rx_bytes'] + n['tx_bytes'] for n in (stat.get('networks') or {}).itervalues())
+                samples[user_name] = (cpu, net)
+            except (KeyError, TypeError):
+                continue
+        return samples
+
+    def running_users(self):
+        """
+        Returns the names of all users with a running knowrob container on this docker host
+        """
+        suffix = knowrob_container_name('')
+        # linked containers are also listed under /other_container/name
+        return [name[1:-len(suffix)] for cont in self.__client.containers() for name in cont['Names'] or []
+                if name.endswith(suffix) and name.count('/') == 1]
+
+    def has_user_data_container(self, user_name):
+        """
+        Returns True if the data container of the given user exists on this docker host
+        """
+        return self.__get_container(data_container_name(user_name), self.__client.containers(all=True)) is not None
+
+    def load(self):
+        """
+        Returns a dict with the number of running knowrob containers, the memory committed to them and the total
+        memory of the docker host
+        """
+        containers = len(self.running_users())
+        return {'containers': containers,
+                'committed_memory': containers * KNOWROB_MEM_LIMIT,
+                'memory': self.__client.info().get('MemTotal', 0)}
+
     def get_container_ip(self, user_name):
+        if self.__events_connected:
+            ip = self.__sessions.get(user_name, 'ip')
+            if ip is not None:
+                return ip
+            if self.__sessions.get(user_name, 'running') is False:
+                # the container was stopped or removed, docker would not find it either
+                return 'error'
         try:
+            token = self.__sessions.begin(user_name)
             inspect = self.__client.inspect_container(knowrob_container_name(user_name))
+            self.__sessions.fill(user_name, token, **self.__session_state(inspect))
             return inspect['NetworkSettings']['IPAddress']
         except (APIError, DockerException), e:
             sysout("Error in get_container_ip: " + str(e.message) + "\n")
             return 'error'
 
     def container_started(self, user_name, base_image_name=None):
+        if self.__events_connected:
+            running = self.__sessions.get(user_name, 'running')
+            if running is not None:
+                return running
         try:
-            return self.__get_container(knowrob_container_name(user_name), self.__client.containers()) is not None
+            token = self.__sessions.begin(user_name)
+            running = self.__get_container(knowrob_container_name(user_name), self.__client.containers()) is not None
+            if running:
+                self.__sessions.fill(user_name, token, running=True)
+            else:
+                self.__sessions.fill(user_name, token, running=False, ip=None)
+            return running
         except (APIError, DockerException), e:
             sysout("Error in container_exists: " + str(e.message))
             return False
 
+    def container_start_time(self, user_name):
+        """
+        Returns the time the knowrob container of the given user was started as unix timestamp, or None if unknown
+        """
+        if self.__events_connected and self.__sessions.get(user_name, 'running') is not None:
+            return self.__sessions.get(user_name, 'started')
+        self.get_container_ip(user_name)
+        return self.__sessions.get(user_name, 'started')
+
+    def add_event_listener(self, listener):
+        """
+        Registers a function that is called with the action (start, die or destroy) and the container name of each
+        docker container event. It is called with the action 'reset' and no name whenever the event stream connects
+        or disconnects, as events may have been missed.
+        """
+        self.__event_listeners.append(listener)
+
+    def watch_events(self):
+        """
+        Starts a thread that keeps the cached container state up to date with the docker event stream
+        """
+        return start_new_thread(self.__watch_events, ())
+
+    def __watch_events(self):
+        # the event stream may be silent for a long time, so it needs a client without read timeout
+        client = docker.Client(base_url=self.base_url, version='1.22', timeout=None)
+        while True:
+            try:
+                events = client.events(decode=True, filters={'type': 'container',
+                                                             'event': ['start', 'die', 'destroy']})
+                self.__sessions.clear()
+                self.__notify_listeners('reset', None)
+                self.__events_connected = True
+                for event in events:
+                    self.__handle_event(event)
+            except Exception, e:
+                sysout("Error in docker event stream: " + str(e))
+            self.__events_connected = False
+            self.__sessions.clear()
+            self.__notify_listeners('reset', None)
+            sleep(5)
+
+    def __notify_listeners(self, action, name):
+        for listener in self.__event_listeners:
+            try:
+                listener(action, name)
+            except Exception, e:
+                sysout("Error in docker event listener: " + str(e))
+                traceback.print_exc()
+
+    def __handle_event(self, event):
+        name = ((event.get('Actor') or {}).get('Attributes') or {}).get('name') or ''
+        action = event.get('Action') or event.get('status')
+        self.__notify_listeners(action, name)
+        suffix = knowrob_container_name('')
+        if not name.endswith(suffix):
+            return
+        user_name = name[:-len(suffix)]
+        if action == 'start':
+            # the IP is read from docker on the next request
+            self.__sessions.invalidate(user_name)
+        else:
+            self.__sessions.update(user_name, running=False, ip=None)
+
+    @staticmethod
+    def __session_state(inspect):
+        state = {'running': inspect['State']['Running'], 'ip': inspect['NetworkSettings']['IPAddress']}
+        # StartedAt has the form 2016-01-01T12:00:00.123456789Z
+        started = inspect['State'].get('StartedAt') or ''
+        if state['running'] and len(started) >= 19:
+            fraction = started[19:].rstrip('Z')
+            state['started'] = calendar.timegm(strptime(started[:19], '%Y-%m-%dT%H:%M:%S')) + \
+                               (float('0' + fraction) if fraction.startswith('.') else 0.0)
+        return state
+
+    @staticmethod
+    def __is_paused(container):
+        return container is not None and '(Paused)' in (container.get('Status') or '')
+
     @staticmethod
     def __get_container(container_name, all_containers):
         for cont in all_containers:
@@ -0,0 +1,544 @@
+"""
+A minimal fake of the docker remote API (version 1.22) for running the dockerbridge without a docker host, e.g. for load
+tests. It keeps containers, networks and the files of data containers in memory and implements the calls the bridge
+makes: container create/start/stop/remove/pause/unpause/inspect/wait/attach/stats, networks, events, info and pull.
+
+Busybox helper containers simulate the commands used by the FileManager for single files and listings (cat, the write
+script, test -e, mkdir, rm and find), other commands exit without output. Knowrob containers run until they are stopped.
+Each running knowrob container gets its own loopback address (127.<subnet>.x.y) as IP, with a stub accepting connections
+on the rosbridge port, so that the readiness checks of the bridge succeed. If the stub can not be bound, e.g. on systems
+that only route 127.0.0.1, use loadtest.py --skip-ready. The cpu and network counters of the container stats grow
+with --cpu-rate and --net-rate while a container runs unpaused. Both default to 0, so that sessions are idle unless the
+bridge is tested with active sessions.
+
+Start with: python fakedocker.py [--port 2375] [--latency 0.002] [--start-latency 0.5] [--stop-latency 0.2] [--subnet N]
+[--cpu-rate 0.0] [--net-rate 0.0]
+and start the bridge with DOCKERBRIDGE_HOSTS=tcp://127.0.0.1:2375. Several fakes on different ports can be used to
+test the distribution of users across hosts, their container addresses differ as the subnet defaults to the port.
+"""
+import argparse
+import json
+import posixpath
+import random
+import re
+import socket
+import struct
+import sys
+import urlparse
+import Queue
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Event, Lock, Thread
+from time import gmtime, sleep, strftime, time
+
+HELPER_IMAGE = 'busybox:latest'
+DATA_IMAGE = 'knowrob/user_data'
+ROSBRIDGE_PORT = 9090
+MEM_TOTAL = 16 * 1024 * 1024 * 1024
+
+
+class FakeContainer(object):
+    def __init__(self, cid, name, config):
+        self.id = cid
+        self.name = name
+        self.image = config.get('Image', '')
+        self.cmd = config.get('Cmd') or []
+        self.env = config.get('Env') or []
+        host_config = config.get('HostConfig') or {}
+        self.volumes_from = host_config.get('VolumesFrom') or []
+        self.created = time()
+        self.started = None
+        self.running = False
+        self.paused = False
+        self.ip = ''
+        self.rosbridge = None
+        self.exit_code = 0
+        self.exited = Event()
+        self.output = ''
+        self.output_ready = Event()
+        self.stdin = None
+        self.stdin_done = Event()
+        self.cpu = 0
+        self.net = 0
+        self.sampled = None
+
+    def status(self):
+        if self.running:
+            return 'Up %d seconds%s' % (time() - self.started, ' (Paused)' if self.paused else '')
+        if self.started is None:
+            return 'Created'
+        return 'Exited (%d) 1 second ago' % self.exit_code
+
+
+class FakeDocker(object):
+    def __init__(self, subnet, start_latency=0.0, stop_latency=0.0, cpu_rate=0.0, net_rate=0.0):
+        self.subnet = subnet
+        self.start_latency = start_latency
+        self.stop_latency = stop_latency
+        # cpu cores and network bytes per second used by running, unpaused containers
+        self.cpu_rate = cpu_rate
+        self.net_rate = net_rate
+        self.lock = Lock()
+        self.containers = {}
+        self.networks = {}
+        # files and directories of the volumes of each container, by container name
+        self.files = {}
+        self.dirs = {}
+        self.subscribers = []
+        self.next_ip = 0
+
+    def find(self, ref):
+        with self.lock:
+            if ref in self.containers:
+                return self.containers[ref]
+            for cont in self.containers.itervalues():
+                if cont.name == ref or cont.id.startswith(ref):
+                    return cont
+        return None
+
+    def create(self, name, config):
+        with self.lock:
+            if name and any(cont.name == name for cont in self.containers.itervalues()):
+                return None
+            cid = '%064x' % random.getrandbits(256)
+            cont = FakeContainer(cid, name or cid[:12], config)
+            self.containers[cid] = cont
+            self.files.setdefault(cont.name, {})
+            self.dirs.setdefault(cont.name, set(['/']))
+        return cont
+
+    def start(self, cont):
+        if cont.running:
+            return
+        if cont.image != HELPER_IMAGE:
+            sleep(self.start_latency)
+        with self.lock:
+            cont.running = True
+            cont.started = time()
+            cont.exited.clear()
+            if cont.image not in (HELPER_IMAGE, DATA_IMAGE):
+                cont.ip = '127.%d.%d.%d' % (self.subnet, self.next_ip // 250 % 250, self.next_ip % 250 + 1)
+                self.next_ip += 1
+        if cont.image == HELPER_IMAGE:
+            Thread(target=self.run_helper, args=(cont,)).start()
+        elif cont.ip:
+            self.bind_rosbridge(cont)
+        self.publish(cont, 'start')
+
+    def stop(self, cont, exit_code=0):
+        if not cont.running:
+            return
+        if cont.image != HELPER_IMAGE:
+            sleep(self.stop_latency)
+        with self.lock:
+            cont.running = False
+            cont.paused = False
+            cont.ip = ''
+            cont.exit_code = exit_code
+            # the stub closes its socket once it sees that it was replaced
+            cont.rosbridge = None
+        cont.output_ready.set()
+        cont.exited.set()
+        self.publish(cont, 'die')
+
+    def remove(self, cont):
+        with self.lock:
+            self.containers.pop(cont.id, None)
+            self.files.pop(cont.name, None)
+            self.dirs.pop(cont.name, None)
+        self.publish(cont, 'destroy')
+
+    @staticmethod
+    def bind_rosbridge(cont):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((cont.ip, ROSBRIDGE_PORT))
+            sock.listen(16)
+        except socket.error, e:
+            print 'Can not bind the rosbridge stub to %s:%d: %s' % (cont.ip, ROSBRIDGE_PORT, e)
+            sock.close()
+            return
+        # a blocked accept is not interrupted by closing the socket, poll until the container stops
+        sock.settimeout(0.5)
+        cont.rosbridge = sock
+
+        def accept():
+            try:
+                while cont.rosbridge is sock:
+                    try:
+                        sock.accept()[0].close()
+                    except socket.timeout:
+                        pass
+            finally:
+                sock.close()
+        thread = Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, cont, action):
+        event = {'status': action, 'id': cont.id, 'from': cont.image, 'Type': 'container', 'Action': action,
+                 'Actor': {'ID': cont.id, 'Attributes': {'name': cont.name, 'image': cont.image}},
+                 'time': int(time())}
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def run_helper(self, cont):
+        try:
+            output, exit_code = self.simulate(cont)
+        except Exception, e:
+            output, exit_code = str(e), 1
+        cont.output = output
+        self.stop(cont, exit_code)
+
+    def simulate(self, cont):
+        volume = cont.volumes_from[-1] if cont.volumes_from else cont.name
+        files = self.files.setdefault(volume, {})
+        dirs = self.dirs.setdefault(volume, set(['/']))
+        cmd = [posixpath.normpath(arg) if arg.startswith('/') else arg for arg in cont.cmd]
+        if cmd[:1] == ['cat'] and len(cmd) == 2:
+            if cmd[1] in files:
+                return files[cmd[1]], 0
+            return '', 1
+        if cmd[:2] == ['test', '-e'] and len(cmd) >= 3:
+            exists = cmd[2] in files or cmd[2] in dirs
+            return ('Yep\n' if exists else ''), (0 if exists else 1)
+        if cmd[:1] == ['mkdir']:
+            self.add_dirs(dirs, cmd[-1])
+            return '', 0
+        if cmd[:1] == ['rm']:
+            path = cmd[-1]
+            for f in [f for f in files if f == path or f.startswith(path + '/')]:
+                del files[f]
+            for d in [d for d in dirs if d == path or d.startswith(path + '/')]:
+                dirs.discard(d)
+            return '', 0
+        if cmd[:2] == ['sh', '-c'] and len(cmd) == 5 and 'mktemp' in cmd[2]:
+            # FileManager.WRITE_SCRIPT, nothing is written if the container is removed before stdin is closed
+            cont.stdin_done.wait(60)
+            if not cont.running:
+                return '', 137
+            files[cmd[4]] = cont.stdin or ''
+            self.add_dirs(dirs, cmd[4].rsplit('/', 1)[0])
+            return '', 0
+        if cmd[:2] == ['sh', '-c'] and len(cmd) >= 3:
+            match = re.match(r"cd (\S+) && find \.( -maxdepth 1)?", cmd[2])
+            if match:
+                base = posixpath.normpath(match.group(1))
+                if base not in dirs:
+                    return '', 1
+                return ''.join(self.find_lines(files, dirs, base, '.', match.group(2) is None)), 0
+        return '', 0
+
+    @staticmethod
+    def add_dirs(dirs, path):
+        parts = path.strip('/').split('/')
+        for i in range(1, len(parts) + 1):
+            dirs.add('/' + '/'.join(parts[:i]))
+
+    def find_lines(self, files, dirs, base, relative, recursive, depth=0):
+        lines = ['d' + relative + '\n'] if depth == 0 else []
+        children = set()
+        for path in list(files) + list(dirs):
+            if path.startswith(base + '/') and '/' not in path[len(base) + 1:]:
+                children.add(path[len(base) + 1:])
+        for child in sorted(children):
+            path = base + '/' + child
+            if path in dirs:
+                lines.append('d' + relative + '/' + child + '\n')
+                if recursive:
+                    lines.extend(self.find_lines(files, dirs, path, relative + '/' + child, recursive, depth + 1))
+            else:
+                lines.append('f' + relative + '/' + child + '\n')
+        return lines
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the bridge closes attach and event streams whenever it is done with them
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    docker = None
+    latency = 0.0
+
+    ROUTES = [
+        ('GET', r'/containers/json$', 'list_containers'),
+        ('POST', r'/containers/create$', 'create_container'),
+        ('GET', r'/containers/([^/]+)/json$', 'inspect_container'),
+        ('POST', r'/containers/([^/]+)/start$', 'start_container'),
+        ('POST', r'/containers/([^/]+)/stop$', 'stop_container'),
+        ('POST', r'/containers/([^/]+)/kill$', 'stop_container'),
+        ('POST', r'/containers/([^/]+)/pause$', 'pause_container'),
+        ('POST', r'/containers/([^/]+)/unpause$', 'unpause_container'),
+        ('POST', r'/containers/([^/]+)/wait$', 'wait_container'),
+        ('POST', r'/containers/([^/]+)/attach$', 'attach_container'),
+        ('GET', r'/containers/([^/]+)/stats$', 'container_stats'),
+        ('DELETE', r'/containers/([^/]+)$', 'remove_container'),
+        ('GET', r'/networks$', 'list_networks'),
+        ('POST', r'/networks/create$', 'create_network'),
+        ('POST', r'/networks/([^/]+)/connect$', 'connect_network'),
+        ('DELETE', r'/networks/([^/]+)$', 'remove_network'),
+        ('POST', r'/images/create$', 'pull_image'),
+        ('GET', r'/events$', 'events'),
+        ('GET', r'/info$', 'info'),
+        ('GET', r'/version$', 'version'),
+        ('GET', r'/_ping$', 'ping'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+    def route(self, method):
+        url = urlparse.urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        self.query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else ''
+        self.body = json.loads(body) if body else {}
+        if self.latency > 0:
+            sleep(self.latency)
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                return getattr(self, name)(*match.groups())
+        self.reply(404, {'message': 'page not found'})
+
+    def reply(self, code, data=None):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def container(self, ref):
+        cont = self.docker.find(ref)
+        if cont is None:
+            self.reply(404, {'message': 'No such container: ' + ref})
+        return cont
+
+    def list_containers(self):
+        show_all = self.query.get('all') in ('1', 'True', 'true')
+        with self.docker.lock:
+            containers = list(self.docker.containers.itervalues())
+        self.reply(200, [{'Id': cont.id, 'Names': ['/' + cont.name], 'Image': cont.image, 'Command': ' '.join(cont.cmd),
+                          'Created': int(cont.created), 'Status': cont.status()}
+                         for cont in containers if show_all or cont.running])
+
+    def create_container(self):
+        cont = self.docker.create(self.query.get('name'), self.body)
+        if cont is None:
+            return self.reply(409, {'message': 'Conflict. The name is already in use'})
+        self.reply(201, {'Id': cont.id, 'Warnings': None})
+
+    def inspect_container(self, ref):
+        cont = self.container(ref)
+        if cont is None:
+            return
+        started = cont.started or 0
+        self.reply(200, {'Id': cont.id, 'Name': '/' + cont.name, 'Image': cont.image,
+                         'State': {'Running': cont.running, 'Paused': cont.paused, 'ExitCode': cont.exit_code,
+                                   'StartedAt': strftime('%Y-%m-%dT%H:%M:%S', gmtime(started)) +
+                                                ('%.9fZ' % (started % 1))[1:]},
+                         'Config': {'Image': cont.image, 'Cmd': cont.cmd, 'Env': cont.env},
+                         'NetworkSettings': {'IPAddress': cont.ip}})
+
+    def start_container(self, ref):
+        cont = self.container(ref)
+        if cont is not None:
+            self.docker.start(cont)
+            self.reply(204)
+
+    def stop_container(self, ref):
+        cont = self.container(ref)
+        if cont is None:
+            return
+        if cont.paused:
+            return self.reply(500, {'message': 'Container ' + ref + ' is paused. Unpause the container first'})
+        self.docker.stop(cont, 137)
+        self.reply(204)
+
+    def pause_container(self, ref):
+        cont = self.container(ref)
+        if cont is not None:
+            cont.paused = True
+            self.reply(204)
+
+    def unpause_container(self, ref):
+        cont = self.container(ref)
+        if cont is not None:
+            cont.paused = False
+            self.reply(204)
+
+    def wait_container(self, ref):
+        cont = self.container(ref)
+        if cont is not None:
+            cont.exited.wait()
+            self.reply(200, {'StatusCode': cont.exit_code})
+
+    def remove_container(self, ref):
+        cont = self.container(ref)
+        if cont is None:
+            return
+        if cont.running:
+            if self.query.get('force') not in ('1', 'True', 'true'):
+                return self.reply(409, {'message': 'You cannot remove a running container. Stop it first'})
+            self.docker.stop(cont, 137)
+        self.docker.remove(cont)
+        self.reply(204)
+
+    def attach_container(self, ref):
+        cont = self.container(ref)
+        if cont is None:
+            return
+        self.send_response(101, 'UPGRADED')
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Upgrade', 'tcp')
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = 1
+        if self.query.get('stdin') == '1':
+            data = []
+            while True:
+                chunk = self.connection.recv(65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            cont.stdin = ''.join(data)
+            cont.stdin_done.set()
+        elif self.query.get('stdout') == '1' or self.query.get('stderr') == '1':
+            cont.output_ready.wait()
+            if cont.output:
+                self.wfile.write(struct.pack('>BxxxL', 1, len(cont.output)) + cont.output)
+            self.wfile.flush()
+
+    def container_stats(self, ref):
+        cont = self.container(ref)
+        if cont is None:
+            return
+        # the counters advance with the configured rates since the last sample, paused time is not counted
+        now = time()
+        if cont.running and not cont.paused:
+            elapsed = now - max(cont.sampled or cont.started, cont.started)
+            cont.cpu += int(elapsed * self.docker.cpu_rate * 10 ** 9)
+            cont.net += int(elapsed * self.docker.net_rate)
+        cont.sampled = now
+        self.reply(200, {'read': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()),
+                         'cpu_stats': {'cpu_usage': {'total_usage': cont.cpu}},
+                         'networks': {'eth0': {'rx_bytes': cont.net // 2, 'tx_bytes': cont.net - cont.net // 2}},
+                         'memory_stats': {'usage': 128 * 1024 * 1024}})
+
+    def list_networks(self):
+        names = json.loads(self.query.get('filters') or '{}').get('name')
+        with self.docker.lock:
+            networks = list(self.docker.networks.itervalues())
+        self.reply(200, [network for network in networks if names is None or network['Name'] in names])
+
+    def create_network(self):
+        network = {'Id': '%064x' % random.getrandbits(256), 'Name': self.body.get('Name'), 'Driver': 'bridge'}
+        with self.docker.lock:
+            self.docker.networks[network['Id']] = network
+        self.reply(201, {'Id': network['Id'], 'Warning': ''})
+
+    def connect_network(self, ref):
+        self.reply(200)
+
+    def remove_network(self, ref):
+        with self.docker.lock:
+            for nid, network in self.docker.networks.items():
+                if nid == ref or network['Name'] == ref:
+                    del self.docker.networks[nid]
+        self.reply(204)
+
+    def pull_image(self):
+        body = json.dumps({'status': 'Image is up to date for ' + self.query.get('fromImage', '')}) + '\r\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def events(self):
+        filters = json.loads(self.query.get('filters') or '{}')
+        actions = filters.get('event')
+        events = Queue.Queue()
+        with self.docker.lock:
+            self.docker.subscribers.append(events)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = 1
+        try:
+            while True:
+                event = events.get()
+                if actions is not None and event['Action'] not in actions:
+                    continue
+                data = json.dumps(event) + '\n'
+                self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+        except IOError:
+            pass
+        finally:
+            with self.docker.lock:
+                self.docker.subscribers.remove(events)
+
+    def info(self):
+        with self.docker.lock:
+            containers = len(self.docker.containers)
+        self.reply(200, {'Containers': containers, 'MemTotal': MEM_TOTAL, 'NCPU': 8, 'Name': 'fakedocker'})
+
+    def version(self):
+        self.reply(200, {'Version': '1.10.0', 'ApiVersion': '1.22'})
+
+    def ping(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('OK')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake docker daemon for dockerbridge load tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2375)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds added to each API call')
+    parser.add_argument('--start-latency', type=float, default=0.5, help='seconds to start a knowrob container')
+    parser.add_argument('--stop-latency', type=float, default=0.2, help='seconds to stop a knowrob container')
+    parser.add_argument('--subnet', type=int, help='second byte of the container addresses 127.<subnet>.x.y, '
+                                                   'derived from the port by default')
+    parser.add_argument('--cpu-rate', type=float, default=0.0,
+                        help='cpu cores used by each running container, 0 keeps idle sessions idle')
+    parser.add_argument('--net-rate', type=float, default=0.0,
+                        help='network bytes per second used by each running container')
+    args = parser.parse_args()
+
+    subnet = args.subnet if args.subnet is not None else args.port % 254 + 1
+    FakeDockerHandler.docker = FakeDocker(subnet, args.start_latency, args.stop_latency, args.cpu_rate, args.net_rate)
+    FakeDockerHandler.latency = args.latency
+    server = ThreadingHTTPServer((args.host, args.port), FakeDockerHandler)
+    print 'Fake docker daemon listening on tcp://%s:%d' % (args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
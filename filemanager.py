@@ -2,10 +2,13 @@
 Basic file handling functions for handling data in docker data containers.
 """
 import StringIO
+import shlex
+from thread import start_new_thread
 
 import docker
 from docker.errors import APIError
 import dockerio
+from utils import sysout
 
 __author__ = 'mhorst@cs.uni-bremen.de'
 
@@ -48,6 +51,115 @@ def lft_transferpath(relative):
     return '/tmp/openEASE/dockerbridge/'+relative
 
 
+def command_path(path):
+    """
+    Returns the path as the commands given as strings see it, for commands given as argument lists. Docker splits
+    string commands like a shell, which removes the backslashes that escape spaces in user paths.
+    """
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    words = shlex.split(path)
+    if len(words) != 1:
+        raise ValueError('Not a single path: ' + path)
+    return words[0]
+
+
+# Lists the files below $1 (section S) and $2 (section T) as 'F size mtime path' lines, paths relative to $1 or $2. If
+# $1 or $2 is a file, it is listed as '.', if it does not exist, a '!' line is listed instead.
+SYNC_MANIFEST_SCRIPT = """
+list() {
+  if [ -d "$1" ]; then
+    cd "$1" && find . -type f -exec stat -c 'F %s %Y %n' {} +
+  elif [ -f "$1" ]; then
+    stat -c 'F %s %Y .' "$1"
+  else
+    echo '!'
+  fi
+}
+echo S; (list "$1")
+echo T; (list "$2")
+"""
+
+# Reads 'C path' (copy $1/path to $2/path) and 'D path' (delete $2/path) lines from stdin and prints 'OK' or 'FAIL'
+# followed by the line for each of them. Copied files keep the modification time of their source.
+SYNC_APPLY_SCRIPT = """
+while IFS= read -r line; do
+  op="${line%% *}"
+  f="${line#* }"
+  if [ "$f" = . ]; then s="$1"; t="$2"; else s="$1/$f"; t="$2/$f"; fi
+  case "$op" in
+    C) mkdir -p "$(dirname "$t")" && cp "$s" "$t" && touch -r "$s" "$t" ;;
+    D) rm -f "$t" ;;
+    *) false ;;
+  esac && echo "OK $line" || echo "FAIL $line"
+done
+"""
+
+# Reads 'offset length last path' lines from stdin and copies length bytes at offset from $1/path to $2/path, with $3
+# bytes per block. The target is truncated when copying from offset 0. If last is 1, the target gets the modification
+# time of the source. Prints 'OK' or 'FAIL' followed by offset and path for each line.
+CHUNK_COPY_SCRIPT = """
+src="$1"; tgt="$2"; bs="$3"
+while IFS= read -r line; do
+  off="${line%% *}"; line="${line#* }"
+  len="${line%% *}"; line="${line#* }"
+  last="${line%% *}"; f="${line#* }"
+  if [ "$f" = . ]; then s="$src"; t="$tgt"; else s="$src/$f"; t="$tgt/$f"; fi
+  if [ "$off" = 0 ]; then conv=; else conv=conv=notrunc; fi
+  mkdir -p "$(dirname "$t")" &&
+  dd if="$s" of="$t" bs=$bs skip=$((off / bs)) seek=$((off / bs)) count=$(((len + bs - 1) / bs)) $conv 2>/dev/null &&
+  { [ "$last" = 0 ] || touch -r "$s" "$t"; } && echo "OK $off $f" || echo "FAIL $off $f"
+done
+"""
+
+# Reads paths from stdin and prints 'H md5 path' for the file $1/path, or 'FAIL path' if it can not be read.
+CHECKSUM_SCRIPT = """
+while IFS= read -r f; do
+  if [ "$f" = . ]; then t="$1"; else t="$1/$f"; fi
+  h="$(md5sum < "$t")" && echo "H ${h%% *} $f" || echo "FAIL $f"
+done
+"""
+
+# Writes stdin to a temporary file next to $1 and moves it over $1 when stdin is closed. A write that is aborted by
+# removing the container leaves the target unchanged, WRITE_CLEANUP_SCRIPT removes its temporary file.
+WRITE_SCRIPT = """
+t="$(mktemp "$1.upload-XXXXXX")" || exit 1
+if cat > "$t" && chmod "$(stat -c %a "$1" 2>/dev/null || echo 644)" "$t" && mv "$t" "$1"; then exit 0; fi
+rm -f "$t"
+exit 1
+"""
+WRITE_CLEANUP_SCRIPT = 'rm -f "$1".upload-*'
+
+# Prints the size of the file $1, followed by a newline and $4 blocks of $2 bytes of it, starting at block $3.
+RANGE_READ_SCRIPT = """
+stat -c %s "$1" || exit 1
+dd if="$1" bs="$2" skip="$3" count="$4" 2>/dev/null
+"""
+
+# Prints the size of the file $1, followed by a newline and the last $4 bytes of the output of tail with option $2 and
+# count $3 for it.
+TAIL_SCRIPT = """
+stat -c %s "$1" || exit 1
+tail "$2" "$3" "$1" | tail -c "$4"
+"""
+
+# Block size for range reads
+RANGE_BLOCK_SIZE = 4096
+
+# Block size for chunked copies, chunk offsets and lengths must be multiples of it
+CHUNK_BLOCK_SIZE = 1024 * 1024
+
+# Lowest expected copy rate in bytes per second, timeouts of copies and checksums are scaled with it
+MIN_TRANSFER_RATE = 4 * 1024 * 1024
+
+
+def transfer_timeout(size):
+    """
+    Returns the seconds to wait for the output of a helper container that copies or reads size bytes without output
+    """
+    return 60 + size / MIN_TRANSFER_RATE
+
+
 class FileManager(object):
     """
     This class provides operations for reading and writing files from docker data containers that are not mounted to
@@ -65,8 +177,8 @@ class FileManager(object):
     temporary containers. For more complex functions, there should be a custom image with a more intelligent (network
     based) solution (preferably some lightweight HTTP REST interface) other than piping stdin/out and using cp and find.
     """
-    def __init__(self):
-        self.docker = docker.Client(base_url='unix://var/run/docker.sock', version='1.22', timeout=10)
+    def __init__(self, base_url='unix://var/run/docker.sock'):
+        self.docker = docker.Client(base_url=base_url, version='1.22', timeout=10)
 
     def fromcontainer(self, container, sourcefile, target):
         """
@@ -87,6 +199,38 @@ class FileManager(object):
         """
         self.__writefile(container, source, targetfile, user)
 
+    def readrange(self, container, sourcefile, offset, length):
+        """
+        Reads a byte range of the sourcefile from the container
+        :param container: container to read in as string
+        :param sourcefile: file to read as string
+        :param offset: position of the first byte to read
+        :param length: maximum number of bytes to read
+        :return: a tuple of the current size of the file and the bytes read, or None if the file could not be read
+        """
+        skip = offset // RANGE_BLOCK_SIZE
+        count = (offset - skip * RANGE_BLOCK_SIZE + length + RANGE_BLOCK_SIZE - 1) // RANGE_BLOCK_SIZE
+        result = self.__sized_output(['sh', '-c', RANGE_READ_SCRIPT, 'sh', command_path(sourcefile),
+                                      str(RANGE_BLOCK_SIZE), str(skip), str(count)], container)
+        if result is None:
+            return None
+        size, data = result
+        start = offset - skip * RANGE_BLOCK_SIZE
+        return size, data[start:start + length]
+
+    def tail(self, container, sourcefile, count, lines=False, limit=1024 * 1024):
+        """
+        Reads the end of the sourcefile from the container
+        :param container: container to read in as string
+        :param sourcefile: file to read as string
+        :param count: number of bytes or lines to read
+        :param lines: set to true to read the last count lines instead of bytes
+        :param limit: maximum number of bytes to read, long lines are cut at the beginning
+        :return: a tuple of the current size of the file and the bytes read, or None if the file could not be read
+        """
+        return self.__sized_output(['sh', '-c', TAIL_SCRIPT, 'sh', command_path(sourcefile), '-n' if lines else '-c',
+                                    str(count), str(limit)], container)
+
     def copy_with_lft(self, container, sourcefile, targetfile, user=0):
         """
         Copies the given sourcefile to the given target with a mounted data container and a large file transfer
@@ -105,6 +249,156 @@ class FileManager(object):
         self.__start_container(cont)
         self.__stop_and_remove(cont, True)
 
+    def sync_with_lft(self, container, sourcefile, targetfile, user=0, checksum=False, delete=False):
+        """
+        Synchronizes the given target with the given source with a mounted data container and a large file transfer
+        container. Unlike copy_with_lft, only files that are missing in the target or differ in size or modification
+        time from the source are copied. If the source is a directory, the target becomes a directory with the same
+        files, if it is a file, the target becomes a copy of that file. Raises an exception if the source does not
+        exist, or if one of them is a file and the other a directory with files.
+        :param container: datacontainer to mount
+        :param sourcefile: file or directory to synchronize the target with
+        :param targetfile: file or directory to update
+        :param user: UID or user name to use for copying
+        :param checksum: compare the md5 sums instead of the modification times of files with equal size
+        :param delete: delete files from the target that do not exist in the source
+        :return: a dict with the number of copied, skipped and deleted files, the copied and skipped bytes and a list
+        of the relative paths that failed
+        """
+        source, target = self.manifest_with_lft(container, sourcefile, targetfile, user, checksum)
+        # A file is listed as '.', a directory by its contents. Syncing a file with a directory or vice versa would
+        # delete the target's contents or fail for each file, an empty target directory is left to cp.
+        if target and ('.' in source) != ('.' in target):
+            raise Exception('Can not synchronize a file with a directory: ' + sourcefile + ', ' + targetfile)
+        report = {'copied_files': 0, 'copied_bytes': 0, 'skipped_files': 0, 'skipped_bytes': 0, 'deleted_files': 0,
+                  'failed': []}
+        plan = []
+        for path in sorted(source):
+            if self.__unchanged(source[path], target.get(path), checksum):
+                report['skipped_files'] += 1
+                report['skipped_bytes'] += source[path]['size']
+            else:
+                plan.append('C ' + path)
+        if delete:
+            plan.extend('D ' + path for path in sorted(target) if path not in source)
+        if len(plan) == 0:
+            return report
+
+        # the script prints a line after each file, so the timeout has to cover the largest copy
+        largest = max([source[line[2:]]['size'] for line in plan if line.startswith('C ')] or [0])
+        result = self.__lft_io(['sh', '-c', SYNC_APPLY_SCRIPT, 'sh', command_path(sourcefile),
+                                command_path(targetfile)],
+                               container, StringIO.StringIO(''.join(line + '\n' for line in plan)), user,
+                               transfer_timeout(largest))
+        for line in result.splitlines():
+            status, _, entry = line.partition(' ')
+            op, _, path = entry.partition(' ')
+            if status == 'FAIL':
+                report['failed'].append(path)
+            elif status == 'OK' and op == 'C':
+                report['copied_files'] += 1
+                report['copied_bytes'] += source[path]['size']
+            elif status == 'OK' and op == 'D':
+                report['deleted_files'] += 1
+        return report
+
+    def manifest_with_lft(self, container, sourcefile, targetfile, user=0, checksum=False):
+        """
+        Lists the files of the given source and target with a mounted data container and a large file transfer
+        container.
+        :param container: datacontainer to mount
+        :param sourcefile: file or directory to list
+        :param targetfile: file or directory to list
+        :param user: UID or user name to use for listing
+        :param checksum: also list the md5 sums of all files
+        :return: two dicts for source and target, mapping the paths relative to the listed directory (or '.' if a file
+        was listed) to dicts with size, mtime and optionally md5 of the file. A missing target is listed as empty,
+        raises an exception if the source does not exist.
+        """
+        manifest = self.__lft_output(['sh', '-c', SYNC_MANIFEST_SCRIPT, 'sh', command_path(sourcefile),
+                                      command_path(targetfile)], container, user)
+        source, target = self.__parse_manifest(manifest)
+        if source is None:
+            raise Exception('Source does not exist: ' + sourcefile)
+        if target is None:
+            target = {}
+        if checksum:
+            for basefile, files in ((sourcefile, source), (targetfile, target)):
+                if len(files) == 0:
+                    continue
+                timeout = transfer_timeout(max(entry['size'] for entry in files.itervalues()))
+                for path, md5 in self.checksum_with_lft(container, basefile, files.keys(), user, timeout).iteritems():
+                    files[path]['md5'] = md5
+        return source, target
+
+    def checksum_with_lft(self, container, basefile, paths, user=0, timeout=60):
+        """
+        Computes the md5 sums of the given files with a mounted data container and a large file transfer container
+        :param container: datacontainer to mount
+        :param basefile: directory the paths are relative to, or the file itself for the path '.'
+        :param paths: list of relative paths
+        :param user: UID or user name to use for reading
+        :param timeout: seconds to wait for the checksum of a single file
+        :return: a dict mapping the paths to their md5 sums, files that could not be read are left out
+        """
+        result = self.__lft_io(['sh', '-c', CHECKSUM_SCRIPT, 'sh', command_path(basefile)], container,
+                               StringIO.StringIO(''.join(path + '\n' for path in paths)), user, timeout)
+        checksums = {}
+        for line in result.splitlines():
+            if line.startswith('H '):
+                md5, path = line[2:].split(' ', 1)
+                checksums[path] = md5
+        return checksums
+
+    def copy_chunks_with_lft(self, container, sourcefile, targetfile, chunks, user=0, timeout=60):
+        """
+        Copies byte ranges of files with a mounted data container and a large file transfer container
+        :param container: datacontainer to mount
+        :param sourcefile: directory the paths are relative to, or the file itself for the path '.'
+        :param targetfile: directory to copy the files to, or the target file for the path '.'
+        :param chunks: list of (path, offset, length, last) tuples, offset and length must be multiples of
+        CHUNK_BLOCK_SIZE except for the length of the last chunk of a file. last must be True for the last chunk.
+        :param user: UID or user name to use for copying
+        :param timeout: seconds to wait for the copy of a single chunk
+        :return: the list of (path, offset) tuples of the chunks that were copied successfully, also if copying a later
+        chunk failed or timed out
+        """
+        lines = ''.join('%d %d %d %s\n' % (offset, length, 1 if last else 0, path)
+                        for path, offset, length, last in chunks)
+        result = self.__lft_io(['sh', '-c', CHUNK_COPY_SCRIPT, 'sh', command_path(sourcefile),
+                                command_path(targetfile), str(CHUNK_BLOCK_SIZE)],
+                               container, StringIO.StringIO(lines), user, timeout, partial=True)
+        copied = []
+        # if the copy failed, the output ends within a line
+        for line in result.split('\n')[:-1]:
+            if line.startswith('OK '):
+                offset, path = line[3:].split(' ', 1)
+                copied.append((path, int(offset)))
+        return copied
+
+    @staticmethod
+    def __parse_manifest(manifest):
+        # a missing source or target is returned as None
+        trees = {'S': {}, 'T': {}}
+        section = 'S'
+        for line in manifest.splitlines():
+            if line in trees:
+                section = line
+            elif line == '!':
+                trees[section] = None
+            elif line.startswith('F '):
+                size, mtime, path = line[2:].split(' ', 2)
+                trees[section][path] = {'size': int(size), 'mtime': int(mtime)}
+        return trees['S'], trees['T']
+
+    @staticmethod
+    def __unchanged(source, target, checksum):
+        if target is None or source.get('size') != target.get('size'):
+            return False
+        if checksum:
+            return source.get('md5') is not None and source.get('md5') == target.get('md5')
+        return source.get('mtime') == target.get('mtime')
+
     def chown_lft(self, user=0, group=0):
         """
         Runs recursive chown with the given user and group on the lft helper container
@@ -209,6 +503,18 @@ class FileManager(object):
         self.__stop_and_remove(cont, True)
         return result.getvalue().splitlines()
 
+    def __sized_output(self, cmd, data_container):
+        cont = self.__create_temp_container(cmd, data_container)
+        outstream = self.__attach(cont, 'stdout')
+        self.__start_container(cont)
+        result = StringIO.StringIO()
+        self.__pump(outstream, result)
+        self.__stop_and_remove(cont, True)
+        size, newline, data = result.getvalue().partition('\n')
+        if not newline or not size.isdigit():
+            return None
+        return int(size), data
+
     def __readfile(self, data_container, sourcefile, targetstream):
         cont = self.__create_temp_container('cat '+sourcefile, data_container)
         outstream = self.__attach(cont, 'stdout')
@@ -217,15 +523,66 @@ class FileManager(object):
         self.__stop_and_remove(cont, True)
 
     def __writefile(self, data_container, sourcestream, targetfile, user=0):
-        cont = self.__create_temp_container('tee '+targetfile, data_container, user)
+        path = command_path(targetfile)
+        cont = self.__create_temp_container(['sh', '-c', WRITE_SCRIPT, 'sh', path], data_container, user)
         instream = self.__attach(cont, 'stdin')
         self.__start_container(cont)
-        self.__pump(sourcestream, instream)
+        try:
+            self.__pump(sourcestream, instream)
+        except Exception as e:
+            # Remove the container before closing stdin, closing it would replace the target with the partial data.
+            self.__stop_and_remove(cont)
+            instream.stream.fd.close()
+            cont = self.__create_temp_container(['sh', '-c', WRITE_CLEANUP_SCRIPT, 'sh', path], data_container, user)
+            self.__start_container(cont)
+            self.__stop_and_remove(cont, True)
+            raise e
         # docker sometimes doesn't get EOF, thus leaving the socket open with the process still running.
         # close stdin after pumping so it doesn't hang while waiting.
         instream.stream.fd.close()
         self.__stop_and_remove(cont, True)
 
+    def __lft_output(self, cmd, data_container, user=0, timeout=60):
+        return self.__lft_io(cmd, data_container, None, user, timeout)
+
+    def __lft_io(self, cmd, data_container, sourcestream, user=0, timeout=60, partial=False):
+        # timeout applies to each read of the output, None waits as long as the command runs. With partial, the output
+        # read until a failure is returned instead of raising.
+        cont = self.__create_temp_lft_container(cmd, data_container, user)
+        instream = self.__attach(cont, 'stdin') if sourcestream is not None else None
+        outstream = self.__attach(cont, 'stdout', timeout)
+        self.__start_container(cont)
+        if sourcestream is None:
+            result = StringIO.StringIO()
+            self.__pump_or_remove(cont, outstream, result)
+            self.__stop_and_remove(cont, True, timeout)
+            return result.getvalue()
+
+        # write stdin in the background, the container might block on writing stdout otherwise
+        def feed():
+            try:
+                self.__pump(sourcestream, instream)
+            finally:
+                instream.stream.fd.close()
+        start_new_thread(feed, ())
+        result = StringIO.StringIO()
+        try:
+            self.__pump_or_remove(cont, outstream, result)
+            self.__stop_and_remove(cont, True, timeout)
+        except Exception, e:
+            if not partial:
+                raise
+            sysout("Error in large file transfer, keeping the output read so far: " + str(e))
+        return result.getvalue()
+
+    def __pump_or_remove(self, container, instream, outstream):
+        try:
+            self.__pump(instream, outstream)
+        except Exception as e:
+            # If the output stream broke or timed out, kill the remaining container.
+            self.__stop_and_remove(container)
+            raise e
+
     def __pump(self, instream, outstream):
         pump = dockerio.Pump(instream, outstream)
         while True:
@@ -246,8 +603,10 @@ class FileManager(object):
                                             host_config={"LogConfig": {"Config": {}, "Type": "none"},
                                                          "VolumesFrom": volumes})
 
-    def __attach(self, container, streamtype):
+    def __attach(self, container, streamtype, timeout=False):
         socket = self.docker.attach_socket(container, {streamtype: 1, 'stream': 1})
+        if timeout is not False:
+            socket.settimeout(timeout)
         stream = dockerio.Stream(socket)
         return dockerio.Demuxer(stream)
 
@@ -259,11 +618,11 @@ class FileManager(object):
             self.__stop_and_remove(container)
             raise e
 
-    def __stop_and_remove(self, container, wait=False):
+    def __stop_and_remove(self, container, wait=False, timeout=60):
         try:
             if wait:
-                self.docker.wait(container, timeout=60)
-        except APIError as e:
+                self.docker.wait(container, timeout=timeout)
+        except Exception as e:
             # If any error occurs, kill the remaining container.
             self.__stop_and_remove(container)
             raise e
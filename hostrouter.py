@@ -0,0 +1,137 @@
+"""
+Distributes user sessions across several docker hosts. Initialize with HostRouter(hosts) and get the host of a user
+with host(user_name).
+
+A user stays on the host that holds the user's data container. Users without data container are placed on the host
+with the lowest share of committed memory (ties are broken by the number of running containers), skipping hosts that
+are draining. Assignments are remembered, and found again by looking for the data container after a restart.
+"""
+
+import os
+from threading import Lock
+from time import time
+
+from dockermanager import DockerManager, DOCKER_URL
+from filemanager import FileManager
+from readinesswaiter import ReadinessWaiter
+from transfermanager import TransferManager
+from utils import sysout, run_parallel, available_memory_ratio
+
+# Seconds the load of a host is cached for memory pressure checks
+LOAD_CACHE_TIME = 10
+
+
+def parse_hosts(spec):
+    """
+    Parses a comma separated list of docker endpoints, each given as url or name=url, into (name, url) tuples.
+    Endpoints without name are named host0, host1, ...
+    """
+    hosts = []
+    for i, entry in enumerate(e.strip() for e in (spec or DOCKER_URL).split(',') if e.strip()):
+        if '=' in entry:
+            name, url = entry.split('=', 1)
+            hosts.append((name.strip(), url.strip()))
+        else:
+            hosts.append(('host' + str(i), entry))
+    return hosts
+
+
+class DockerHost(object):
+    """
+    A docker host with the managers for its containers and files
+    """
+    def __init__(self, name, url, state_dir):
+        self.name = name
+        self.url = url
+        self.draining = False
+        self.dockermanager = DockerManager(url)
+        self.filemanager = FileManager(url)
+        self.transfers = TransferManager(self.filemanager, os.path.join(state_dir, 'transfers', name))
+        self.readiness = ReadinessWaiter(self.dockermanager.container_started, self.dockermanager.get_container_ip,
+                                         self.dockermanager.container_start_time)
+        self.__load = None
+        self.__load_time = 0
+
+    def load(self, max_age=0):
+        """
+        Returns the load of the host as reported by DockerManager.load, at most max_age seconds old
+        """
+        if self.__load is None or time() - self.__load_time > max_age:
+            self.__load = self.dockermanager.load()
+            self.__load_time = time()
+        return self.__load
+
+    def memory_pressure(self, min_available):
+        """
+        Returns True if less than the given fraction of the host's memory is available. For the local host this is
+        read from /proc/meminfo, for remote hosts it is estimated from the memory committed to knowrob containers.
+        """
+        if self.url.startswith('unix://'):
+            return available_memory_ratio() < min_available
+        try:
+            load = self.load(LOAD_CACHE_TIME)
+        except Exception, e:
+            sysout("Error in memory_pressure for " + self.name + ": " + str(e))
+            return False
+        return load['memory'] > 0 and 1 - float(load['committed_memory']) / load['memory'] < min_available
+
+
+class HostRouter(object):
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.__lock = Lock()
+        self.__assignments = dict()
+
+    def host(self, user_name):
+        """
+        Returns the host of the given user, and places the user on a host if it has none yet
+        """
+        host = self.__assignments.get(user_name)
+        if host is not None:
+            return host
+        if len(self.hosts) == 1:
+            host = self.hosts[0]
+        else:
+            host = self.__find(user_name) or self.__place(user_name)
+        with self.__lock:
+            return self.__assignments.setdefault(user_name, host)
+
+    def by_name(self, name):
+        for host in self.hosts:
+            if host.name == name:
+                return host
+        return None
+
+    def users(self, host):
+        """
+        Returns the names of the users that are assigned to the given host
+        """
+        return [user_name for user_name, assigned in self.__assignments.items() if assigned is host]
+
+    def __find(self, user_name):
+        found = run_parallel(lambda host: host.dockermanager.has_user_data_container(user_name), self.hosts)
+        for host in self.hosts:
+            if found[host] is True:
+                return host
+        for host in self.hosts:
+            # the user's data might be on the unreachable host, placing the user elsewhere would split it
+            if isinstance(found[host], Exception):
+                raise Exception('Docker host ' + host.name + ' is unreachable, can not locate ' + user_name)
+        return None
+
+    def __place(self, user_name):
+        candidates = [host for host in self.hosts if not host.draining]
+        if len(candidates) == 0:
+            raise Exception('All docker hosts are draining, can not place ' + user_name)
+        loads = run_parallel(lambda host: host.load(), candidates)
+        available = [host for host in candidates if not isinstance(loads[host], Exception)]
+        if len(available) == 0:
+            raise Exception('No docker host is reachable, can not place ' + user_name)
+
+        def score(host):
+            load = loads[host]
+            memory = load['memory'] or 1
+            return float(load['committed_memory']) / memory, load['containers']
+        host = min(available, key=score)
+        sysout('Placing ' + user_name + ' on docker host ' + host.name)
+        return host
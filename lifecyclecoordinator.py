@@ -0,0 +1,78 @@
+"""
+Coordinates lifecycle operations (start, stop, ...) of the containers of each user. Initialize with
+LifecycleCoordinator() and run operations with run(user_name, key, func, *args).
+
+Operations for the same user are executed one after another in the order they were requested. If an operation is
+requested while an identical operation (same key) is the last one queued or running for that user, the request is
+merged into it instead of being queued again: func is not called a second time and all callers receive the result (or
+exception) of the shared operation. Operations for different users run in parallel.
+"""
+
+import sys
+from threading import Condition, Event, Lock
+
+
+class _Operation(object):
+    def __init__(self, key, ticket):
+        self.key = key
+        self.ticket = ticket
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class _UserQueue(object):
+    def __init__(self, lock):
+        self.turn = Condition(lock)
+        self.tail = None
+        self.next_ticket = 0
+        self.serving = 0
+        self.callers = 0
+
+
+class LifecycleCoordinator(object):
+    def __init__(self):
+        self.__lock = Lock()
+        self.__queues = dict()
+
+    def run(self, user_name, key, func, *args):
+        """
+        Runs func(*args) as lifecycle operation for the given user, or joins an identical pending operation.
+        :param user_name: user the operation belongs to
+        :param key: identifies the operation, operations with equal keys are merged
+        :param func: function performing the operation
+        :return: the result of the operation
+        """
+        with self.__lock:
+            queue = self.__queues.get(user_name)
+            if queue is None:
+                queue = self.__queues[user_name] = _UserQueue(self.__lock)
+            queue.callers += 1
+            operation = queue.tail
+            owner = operation is None or operation.key != key or operation.done.is_set()
+            if owner:
+                operation = _Operation(key, queue.next_ticket)
+                queue.next_ticket += 1
+                queue.tail = operation
+                while queue.serving != operation.ticket:
+                    queue.turn.wait()
+        try:
+            if owner:
+                try:
+                    operation.result = func(*args)
+                except Exception:
+                    operation.error = sys.exc_info()
+                with self.__lock:
+                    operation.done.set()
+                    queue.serving += 1
+                    queue.turn.notify_all()
+            else:
+                operation.done.wait()
+        finally:
+            with self.__lock:
+                queue.callers -= 1
+                if queue.callers == 0:
+                    del self.__queues[user_name]
+        if operation.error is not None:
+            raise operation.error[0], operation.error[1], operation.error[2]
+        return operation.result
@@ -0,0 +1,278 @@
+"""
+Load test for the dockerbridge. Simulated users arrive as a Poisson process and go through the lifecycle of an openEASE
+session: login (create the data container, start knowrob and wait until it is ready), a session of polling and file
+editing with exponentially distributed think times, and either logout or walking away so that the session ends through
+the idle timeout of the bridge.
+
+The arrival rate is raised in steps. For every step the sustained throughput, the latency percentiles of each RPC and
+the error rate are reported. The saturation point is the first step where the 99th percentile latency exceeds the SLO
+or the error rate exceeds the error budget, the step before is the highest sustainable arrival rate.
+
+Against a fake docker daemon (see fakedocker.py):
+    python fakedocker.py --port 2375 &
+    DOCKERBRIDGE_HOSTS=tcp://127.0.0.1:2375 DOCKERBRIDGE_STATE_DIR=/tmp/dockerbridge python dockerbridge.py &
+    python loadtest.py --rates 0.5,1,2,4,8 --step 60
+If the fake can not provide the rosbridge stub for the readiness check, add --skip-ready.
+Against a bridge in front of a real docker host, point --url to it. Sessions started by the test are stopped at the
+end unless --keep is given.
+"""
+import argparse
+import base64
+import json
+import random
+import sys
+import threading
+import time
+
+import pyjsonrpc
+
+NEEM_HUB_SETTINGS = json.dumps({'mongo_user': 'loadtest', 'mongo_pass': 'loadtest', 'mongo_db': 'neems',
+                                'mongo_host': 'mongo', 'mongo_port': '27017', 'urdf_server': ''})
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0-100) of the given sorted values using the nearest rank, None if there are none
+    """
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+class StepRecorder(object):
+    """
+    Collects the latencies and errors of all RPCs completed during one step of the test
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.sessions = 0
+        self.failed_sessions = 0
+        self.active_peak = 0
+        self.started = time.time()
+        self.ended = None
+
+    def record(self, method, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(method, []).append(seconds)
+            if not ok:
+                self.errors[method] = self.errors.get(method, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            duration = (self.ended or time.time()) - self.started
+            methods = {}
+            everything = []
+            for method, latencies in self.latencies.iteritems():
+                latencies = sorted(latencies)
+                everything.extend(latencies)
+                methods[method] = {'calls': len(latencies), 'errors': self.errors.get(method, 0),
+                                   'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                   'p99': percentile(latencies, 99)}
+            everything.sort()
+            calls = len(everything)
+            errors = sum(self.errors.itervalues())
+            return {'rate': self.rate, 'duration': duration, 'sessions': self.sessions,
+                    'failed_sessions': self.failed_sessions, 'active_peak': self.active_peak,
+                    'calls': calls, 'throughput': calls / duration if duration > 0 else 0.0,
+                    'error_rate': float(errors) / calls if calls else 0.0,
+                    'p50': percentile(everything, 50), 'p95': percentile(everything, 95),
+                    'p99': percentile(everything, 99), 'methods': methods}
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.recorder = None
+        self.users = []
+        self.active = 0
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def run(self):
+        results = []
+        for rate in self.args.rates:
+            self.recorder = StepRecorder(rate)
+            self.__arrivals(rate, self.args.step)
+            self.recorder.ended = time.time()
+            summary = self.recorder.summary()
+            results.append(summary)
+            self.__print_step(summary)
+            if self.__saturated(summary) and not self.args.no_stop:
+                break
+        self.stopping.set()
+        deadline = time.time() + self.args.drain
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.time()))
+        if not self.args.keep:
+            self.__cleanup()
+        return results
+
+    def __arrivals(self, rate, duration):
+        end = time.time() + duration
+        while True:
+            arrival = time.time() + random.expovariate(rate)
+            if arrival >= end:
+                time.sleep(max(0.0, end - time.time()))
+                return
+            time.sleep(max(0.0, arrival - time.time()))
+            with self.lock:
+                user_name = 'load%d%s' % (len(self.users), '%06x' % random.getrandbits(24))
+                self.users.append(user_name)
+            thread = threading.Thread(target=self.__session, args=(user_name,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __call(self, client, method, *params, **kwargs):
+        # the bridge reports some failures in the result instead of an error, check tells these apart
+        check = kwargs.get('check')
+        recorder = self.recorder
+        begin = time.time()
+        try:
+            result = client.call(method, *params)
+        except Exception:
+            recorder.record(method, time.time() - begin, False)
+            raise
+        ok = check is None or check(result)
+        recorder.record(method, time.time() - begin, ok)
+        if not ok:
+            raise Exception('Unexpected result of ' + method)
+        return result
+
+    def __session(self, user_name):
+        client = pyjsonrpc.HttpClient(self.args.url, timeout=self.args.rpc_timeout)
+        with self.lock:
+            self.active += 1
+            recorder = self.recorder
+            recorder.sessions += 1
+            recorder.active_peak = max(recorder.active_peak, self.active)
+        try:
+            self.__login(client, user_name)
+            self.__work(client, user_name)
+            if random.random() < self.args.logout:
+                self.__call(client, 'stop_user_container', user_name)
+        except Exception:
+            with self.lock:
+                self.recorder.failed_sessions += 1
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def __login(self, client, user_name):
+        self.__call(client, 'create_user_data_container', user_name)
+        self.__call(client, 'start_user_container', user_name, NEEM_HUB_SETTINGS)
+        if self.args.skip_ready:
+            return
+        self.__call(client, 'wait_until_ready', user_name, self.args.ready_timeout,
+                    check=lambda ready: ready and ready.get('ready'))
+
+    def __work(self, client, user_name):
+        end = time.time() + random.expovariate(1.0 / self.args.session)
+        files = []
+        while time.time() < end and not self.stopping.is_set():
+            self.stopping.wait(random.expovariate(1.0 / self.args.think))
+            if random.random() < self.args.edit:
+                files.append(self.__edit(client, user_name, len(files)))
+            else:
+                self.__call(client, 'container_started', user_name)
+                self.__call(client, 'refresh', user_name)
+
+    def __edit(self, client, user_name, index):
+        path = 'loadtest/file%d.pl' % (index % 8)
+        content = base64.b64encode(''.join(chr(random.getrandbits(7) + 32) for _ in range(self.args.file_size)))
+        self.__call(client, 'files_ls', user_name, '.', False)
+        self.__call(client, 'files_tocontainer', user_name, content, path)
+        self.__call(client, 'files_fromcontainer', user_name, path, check=lambda data: data == content)
+        return path
+
+    def __cleanup(self):
+        client = pyjsonrpc.HttpClient(self.args.url, timeout=max(self.args.rpc_timeout, 600))
+        with self.lock:
+            users = list(self.users)
+        if users:
+            sys.stdout.write('Stopping %d test sessions\n' % len(users))
+            client.call('stop_user_containers', users, 16)
+
+    def __saturated(self, summary):
+        return (summary['p99'] is not None and summary['p99'] > self.args.slo) or \
+            summary['error_rate'] > self.args.error_budget
+
+    def __print_step(self, summary):
+        def ms(seconds):
+            return '%8.1f' % (seconds * 1000.0) if seconds is not None else '       -'
+        out = sys.stdout
+        out.write('\n== %.2f users/s: %d sessions (%d failed), peak %d active, %.1f calls/s, %.2f%% errors\n' %
+                  (summary['rate'], summary['sessions'], summary['failed_sessions'], summary['active_peak'],
+                   summary['throughput'], summary['error_rate'] * 100))
+        out.write('%-28s %7s %7s %8s %8s %8s\n' % ('method', 'calls', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for method, stats in sorted(summary['methods'].iteritems()):
+            out.write('%-28s %7d %7d %s %s %s\n' % (method, stats['calls'], stats['errors'],
+                                                    ms(stats['p50']), ms(stats['p95']), ms(stats['p99'])))
+        out.write('%-28s %7d %7s %s %s %s\n' % ('all', summary['calls'], '', ms(summary['p50']), ms(summary['p95']),
+                                                ms(summary['p99'])))
+        out.flush()
+
+    def report(self, results):
+        sustainable = None
+        saturation = None
+        for summary in results:
+            if self.__saturated(summary):
+                saturation = summary
+                break
+            sustainable = summary
+        out = sys.stdout
+        out.write('\n')
+        if sustainable is not None:
+            out.write('Sustainable: %.2f users/s (peak %d active sessions, %.1f calls/s, p99 %.1f ms)\n' %
+                      (sustainable['rate'], sustainable['active_peak'], sustainable['throughput'],
+                       (sustainable['p99'] or 0) * 1000.0))
+        if saturation is not None:
+            out.write('Saturation point: %.2f users/s (p99 %.1f ms, %.2f%% errors)\n' %
+                      (saturation['rate'], (saturation['p99'] or 0) * 1000.0, saturation['error_rate'] * 100))
+        else:
+            out.write('Not saturated up to %.2f users/s\n' % results[-1]['rate'])
+        if self.args.json:
+            with open(self.args.json, 'w') as f:
+                json.dump({'sustainable': sustainable and sustainable['rate'],
+                           'saturation': saturation and saturation['rate'], 'steps': results}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for the dockerbridge with simulated user sessions')
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='JSON-RPC url of the bridge')
+    parser.add_argument('--rates', default='0.5,1,2,4,8',
+                        type=lambda s: [float(r) for r in s.split(',')], help='arrival rates in users/s, one per step')
+    parser.add_argument('--step', type=float, default=60, help='seconds per step')
+    parser.add_argument('--session', type=float, default=120, help='mean session length in seconds')
+    parser.add_argument('--think', type=float, default=5, help='mean think time between actions in seconds')
+    parser.add_argument('--edit', type=float, default=0.3, help='fraction of actions that edit a file, others poll')
+    parser.add_argument('--file-size', type=int, default=4096, help='bytes written per file edit')
+    parser.add_argument('--logout', type=float, default=0.5,
+                        help='fraction of sessions that log out, the others are left to the idle timeout')
+    parser.add_argument('--ready-timeout', type=float, default=60, help='seconds to wait for knowrob to be ready')
+    parser.add_argument('--skip-ready', action='store_true',
+                        help='do not wait until knowrob is ready, for fake daemons that can not run a rosbridge stub')
+    parser.add_argument('--rpc-timeout', type=float, default=120, help='seconds before a single RPC fails')
+    parser.add_argument('--slo', type=float, default=2.0, help='99th percentile latency objective in seconds')
+    parser.add_argument('--error-budget', type=float, default=0.01, help='maximum fraction of failed calls')
+    parser.add_argument('--no-stop', action='store_true', help='run all steps even after saturation')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for running sessions to end')
+    parser.add_argument('--keep', action='store_true', help='do not stop the test sessions at the end')
+    parser.add_argument('--seed', type=int, help='random seed for reproducible runs')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    test = LoadTest(args)
+    test.report(test.run())
+
+
+if __name__ == '__main__':
+    main()
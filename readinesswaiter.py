@@ -0,0 +1,102 @@
+"""
+Waits until the rosbridge websocket of a user's knowrob container accepts connections. Initialize with
+ReadinessWaiter(startedFunc, ipFunc, startTimeFunc) and block with wait(user_name, timeout).
+
+All requests waiting for the same user share one checker thread that polls startedFunc and then probes the rosbridge
+port of the IP returned by ipFunc. The waiting requests themselves only block on an event until the checker finishes,
+they do not poll docker or the container.
+
+The time to ready is measured once per container start by the first checker that saw the container not ready yet and
+is reported unchanged by later waits. It is None if the container was already ready when it was first checked.
+"""
+
+import socket
+from thread import start_new_thread
+from threading import Event, Lock
+from time import sleep, time
+
+
+class _Check(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.done = Event()
+        self.result = None
+
+
+class ReadinessWaiter(object):
+    def __init__(self, startedFunc, ipFunc, startTimeFunc, port=9090, interval=0.25):
+        """
+        :param startedFunc: returns True if the container of the given user is running
+        :param ipFunc: returns the IP of the container of the given user
+        :param startTimeFunc: returns the start time of the container of the given user as unix timestamp, or None
+        :param port: port that has to accept connections
+        :param interval: seconds between two checks
+        """
+        self.startedFunc = startedFunc
+        self.ipFunc = ipFunc
+        self.startTimeFunc = startTimeFunc
+        self.port = port
+        self.interval = interval
+        self.__lock = Lock()
+        self.__checks = dict()
+        # user_name -> (start time, time to ready) of the last container start that was seen ready
+        self.__ready = dict()
+
+    def wait(self, user_name, timeout):
+        """
+        Blocks until the container of the given user is ready or the timeout is reached.
+        :return: a dict with the ip of the container and the time_to_ready in seconds from the container start until it
+        was first seen ready (None if unknown), or None if the container did not become ready within the timeout
+        """
+        deadline = time() + timeout
+        with self.__lock:
+            check = self.__checks.get(user_name)
+            if check is None:
+                check = self.__checks[user_name] = _Check(deadline)
+                start_new_thread(self.__check, (user_name, check))
+            else:
+                check.deadline = max(check.deadline, deadline)
+        check.done.wait(max(0, deadline - time()))
+        return check.result
+
+    def __check(self, user_name, check):
+        observed = False
+        try:
+            while True:
+                if self.startedFunc(user_name):
+                    ip = self.ipFunc(user_name)
+                    if ip and ip != 'error' and self.__accepts_connections(ip):
+                        check.result = {'ip': ip, 'time_to_ready': self.__time_to_ready(user_name, observed)}
+                        return
+                observed = True
+                with self.__lock:
+                    # Waiters may extend the deadline until the check is unregistered
+                    if time() + self.interval >= check.deadline:
+                        del self.__checks[user_name]
+                        return
+                sleep(self.interval)
+        finally:
+            with self.__lock:
+                if self.__checks.get(user_name) is check:
+                    del self.__checks[user_name]
+            check.done.set()
+
+    def __time_to_ready(self, user_name, observed):
+        started = self.startTimeFunc(user_name)
+        if started is None:
+            return None
+        with self.__lock:
+            cached = self.__ready.get(user_name)
+            if cached is not None and cached[0] == started:
+                return cached[1]
+            # Only a checker that saw the container not ready knows when it became ready, otherwise it is the uptime
+            time_to_ready = time() - started if observed else None
+            self.__ready[user_name] = (started, time_to_ready)
+            return time_to_ready
+
+    def __accepts_connections(self, ip):
+        try:
+            socket.create_connection((ip, self.port), 1).close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
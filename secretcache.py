@@ -0,0 +1,99 @@
+"""
+Caches the rosauth secrets of data containers in memory. Initialize with SecretCache(ttl_in_seconds) (None for no
+expiry), read with get(container) and store with put(container, secret). Unicode secrets are stored and returned
+encoded as UTF-8.
+
+Secrets are kept in bytearrays that are locked into memory with mlock where the platform allows it, so they are not
+swapped to disk, and are overwritten with zeros when they are dropped. They are never logged. As with SessionCache, a
+secret read from a container is stored with begin(container) and fill(container, token, secret), so that it can not
+overwrite a secret that was written in the meantime.
+"""
+
+import ctypes
+import ctypes.util
+from threading import Lock
+from time import time
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (OSError, TypeError):
+    _libc = None
+
+
+class _Secret(object):
+    def __init__(self, secret, expires):
+        # secrets from the RPC are unicode, bytearray only takes them with an encoding
+        self.data = bytearray(secret.encode('utf-8') if isinstance(secret, unicode) else secret)
+        self.expires = expires
+        self.buffer = (ctypes.c_char * len(self.data)).from_buffer(self.data) if len(self.data) > 0 else None
+        self.locked = self.buffer is not None and _libc is not None and _libc.mlock(*self.__range()) == 0
+
+    def wipe(self):
+        if self.buffer is None:
+            return
+        ctypes.memset(ctypes.addressof(self.buffer), 0, len(self.data))
+        if self.locked:
+            _libc.munlock(*self.__range())
+        self.buffer = None
+
+    def __range(self):
+        return ctypes.c_void_p(ctypes.addressof(self.buffer)), ctypes.c_size_t(len(self.data))
+
+    def __repr__(self):
+        return '_Secret(<hidden>)'
+
+
+class SecretCache(object):
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.__lock = Lock()
+        self.__secrets = dict()
+        self.__versions = dict()
+        self.__epoch = 0
+
+    def get(self, container):
+        """
+        Returns the cached secret of the given data container, or None if it is not cached or expired
+        """
+        with self.__lock:
+            entry = self.__secrets.get(container)
+            if entry is None:
+                return None
+            if entry.expires is not None and entry.expires < time():
+                self.__drop(container)
+                return None
+            return str(entry.data)
+
+    def begin(self, container):
+        with self.__lock:
+            return self.__epoch, self.__versions.get(container, 0)
+
+    def fill(self, container, token, secret):
+        with self.__lock:
+            if (self.__epoch, self.__versions.get(container, 0)) == token:
+                self.__set(container, secret)
+
+    def put(self, container, secret):
+        with self.__lock:
+            self.__set(container, secret)
+
+    def invalidate(self, container):
+        with self.__lock:
+            self.__drop(container)
+
+    def clear(self):
+        with self.__lock:
+            for container in self.__secrets.keys():
+                self.__drop(container)
+            self.__versions.clear()
+            self.__epoch += 1
+
+    def __set(self, container, secret):
+        self.__drop(container)
+        self.__secrets[container] = _Secret(secret, time() + self.ttl if self.ttl is not None else None)
+
+    def __drop(self, container):
+        entry = self.__secrets.pop(container, None)
+        if entry is not None:
+            entry.wipe()
+        self.__versions[container] = self.__versions.get(container, 0) + 1
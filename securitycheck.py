@@ -53,3 +53,13 @@ def check_pathname(input, paramname):
         if re.match(result.group(), '[^\\\\] '):
             raise SecurityException('The path in '+paramname+' must not contain spaces without preceding backslash')
         raise SecurityException(paramname, result.group())
+
+
+def check_count(input, paramname):
+    try:
+        value = int(input)
+    except (TypeError, ValueError):
+        raise SecurityException('The value of '+paramname+' must be an integer')
+    if value < 0:
+        raise SecurityException('The value of '+paramname+' must not be negative')
+    return value
@@ -0,0 +1,60 @@
+"""
+Caches the state of user sessions (running flag, container IP, start time) to answer frequent polls without querying
+docker. Entries are updated with update(user_name, **fields) and dropped with invalidate(user_name).
+
+To fill the cache from a docker query, get a token with begin(user_name) before sending the query and pass it to
+fill(user_name, token, **fields) afterwards. If the entry was updated or invalidated in the meantime, e.g. because a
+docker event arrived while the query was running, the possibly outdated result is not stored.
+"""
+
+from threading import Lock
+
+
+class SessionCache(object):
+    def __init__(self):
+        self.__lock = Lock()
+        self.__entries = dict()
+        self.__versions = dict()
+        self.__epoch = 0
+
+    def get(self, user_name, field):
+        """
+        Returns the cached value of field for the given user, or None if it is not cached
+        """
+        entry = self.__entries.get(user_name)
+        if entry is None:
+            return None
+        return entry.get(field)
+
+    def begin(self, user_name):
+        with self.__lock:
+            return self.__epoch, self.__versions.get(user_name, 0)
+
+    def fill(self, user_name, token, **fields):
+        with self.__lock:
+            if (self.__epoch, self.__versions.get(user_name, 0)) == token:
+                self.__set(user_name, fields)
+
+    def update(self, user_name, **fields):
+        with self.__lock:
+            self.__set(user_name, fields)
+
+    def invalidate(self, user_name):
+        with self.__lock:
+            self.__entries.pop(user_name, None)
+            self.__bump(user_name)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__versions.clear()
+            self.__epoch += 1
+
+    def __set(self, user_name, fields):
+        entry = dict(self.__entries.get(user_name, {}))
+        entry.update(fields)
+        self.__entries[user_name] = entry
+        self.__bump(user_name)
+
+    def __bump(self, user_name):
+        self.__versions[user_name] = self.__versions.get(user_name, 0) + 1
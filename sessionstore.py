@@ -0,0 +1,46 @@
+"""
+Persists the session timeouts of the TimeoutManager in a small SQLite database, so they survive restarts of the bridge.
+Initialize with SessionStore(path). Entries are dicts with the timeout and pause timeout (unix timestamps, pause may be
+None) and the paused flag of a session, load() returns them in the form TimeoutManager.restore() takes.
+
+The database runs in WAL mode with synchronous=NORMAL, so writing an entry only appends to the log and does not wait for
+the disk. A crash of the host may lose the last writes, which only makes restored sessions expire a little early.
+"""
+
+import sqlite3
+from threading import Lock
+
+from utils import sysout
+
+
+class SessionStore(object):
+    def __init__(self, path):
+        self.__lock = Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS sessions '
+                          '(name TEXT PRIMARY KEY, timeout REAL NOT NULL, pause REAL, paused INTEGER NOT NULL)')
+
+    def put(self, name, entry):
+        self.__execute('INSERT OR REPLACE INTO sessions (name, timeout, pause, paused) VALUES (?, ?, ?, ?)',
+                       (name, entry['timeout'], entry.get('pause'), 1 if entry.get('paused') else 0))
+
+    def remove(self, name):
+        self.__execute('DELETE FROM sessions WHERE name = ?', (name,))
+
+    def load(self):
+        """
+        Returns a dict mapping the names of all stored sessions to their entries
+        """
+        with self.__lock:
+            rows = self.__db.execute('SELECT name, timeout, pause, paused FROM sessions').fetchall()
+        return dict((str(name), {'timeout': timeout, 'pause': pause, 'paused': bool(paused)})
+                    for name, timeout, pause, paused in rows)
+
+    def __execute(self, sql, params):
+        try:
+            with self.__lock:
+                self.__db.execute(sql, params)
+        except sqlite3.Error, e:
+            sysout("Error in SessionStore: " + str(e))
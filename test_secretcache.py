@@ -0,0 +1,29 @@
+import json
+import unittest
+
+from secretcache import SecretCache
+
+
+class SecretCacheTest(unittest.TestCase):
+    def test_put_unicode_from_json(self):
+        secret = json.loads('{"secret": "s\\u00e9cret"}')['secret']
+        cache = SecretCache()
+        cache.put('user_data', secret)
+        self.assertEqual(cache.get('user_data'), secret.encode('utf-8'))
+
+    def test_fill_after_put_is_dropped(self):
+        cache = SecretCache()
+        token = cache.begin('user_data')
+        cache.put('user_data', 'written')
+        cache.fill('user_data', token, 'read')
+        self.assertEqual(cache.get('user_data'), 'written')
+
+    def test_invalidate(self):
+        cache = SecretCache()
+        cache.put('user_data', u'secret')
+        cache.invalidate('user_data')
+        self.assertIsNone(cache.get('user_data'))
+
+
+if __name__ == '__main__':
+    unittest.main()
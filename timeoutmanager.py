@@ -5,9 +5,23 @@ ran into a timeout, the manager will call the callback function with the client
 start(), set the timeout for a client with setTimeout(client, seconds_from_now), or remove the timeout for a client with
 remove(client). You can reset the timeout for a client by calling resetTimeout, this will refresh the timeout, if a
 timeout was previously assigned to that client.
+
+Optionally, clients can go through an idle stage before they time out: if a pauseFunc is given and a pause timeout is
+passed to setTimeout/resetTimeout, the manager calls pauseFunc with the client name once the pause timeout is reached.
+The next resetTimeout for a paused client calls resumeFunc after refreshing the timeouts. resumeFunc returns True if
+the client was resumed, otherwise the client stays paused. If pressureFunc is given, it is called with the names of the
+paused clients, longest idle first, on each check, and the first client it returns True for is timed out early.
+
+A callbackFunc returning False or a pauseFunc returning None skips the client, it is checked again on the next check.
+Errors of the functions are logged and do not affect the other clients.
+
+If a store (see SessionStore) is given, all changes of the timeouts are written to it. Changes of a timeout by less
+than storeSlack seconds are not written, so that frequent refreshes do not cause a write each. The timeouts can be
+restored from the store with restore(store.load()).
 """
 
 from thread import start_new_thread
+from threading import Lock
 from time import sleep, time
 from utils import sysout
 
@@ -15,34 +29,170 @@ __author__ = 'mhorst@cs.uni-bremen.de'
 
 
 class TimeoutManager(object):
-    def __init__(self, interval, callbackFunc):
+    def __init__(self, interval, callbackFunc, pauseFunc=None, resumeFunc=None, pressureFunc=None, store=None,
+                 storeSlack=15):
         self.interval = interval
         self.callbackFunc = callbackFunc
+        self.pauseFunc = pauseFunc
+        self.resumeFunc = resumeFunc
+        self.pressureFunc = pressureFunc
+        self.pauses = dict()
+        self.paused = set()
+        self.lock = Lock()
+        self.store = store
+        self.storeSlack = storeSlack
+        self.stored = dict()
 
     clients = dict()
 
     def start(self):
         return start_new_thread(self.__watchdog, ())
 
-    def setTimeout(self, name, seconds):
-        self.clients[name] = time() + seconds
+    def setTimeout(self, name, seconds, pauseSeconds=None):
+        with self.lock:
+            self.clients[name] = time() + seconds
+            self.__setPause(name, pauseSeconds)
+            self.paused.discard(name)
+            self.__persist(name)
         sysout('Timeout added for '+name+', terminating in '+str(seconds)+' seconds')
 
-    def resetTimeout(self, name, seconds):
-        if name in self.clients:
+    def resetTimeout(self, name, seconds, pauseSeconds=None):
+        with self.lock:
+            if name not in self.clients:
+                return
+            resume = name in self.paused
+            self.paused.discard(name)
             self.clients[name] = time() + seconds
-            sysout('Timeout reset for '+name+', terminating in '+str(seconds)+' seconds')
+            self.__setPause(name, pauseSeconds)
+            self.__persist(name)
+        if resume:
+            self.__resume(name)
+        sysout('Timeout reset for '+name+', terminating in '+str(seconds)+' seconds')
+
+    def activeClients(self):
+        """
+        Returns the names of all clients with a timeout that are not paused
+        """
+        return [name for name in self.clients.keys() if name not in self.paused]
+
+    def restore(self, entries):
+        """
+        Adds the timeouts loaded from the store, timeouts that passed in the meantime are reached on the next check
+        """
+        with self.lock:
+            for name, entry in entries.iteritems():
+                self.clients[name] = entry['timeout']
+                if entry.get('pause') is not None and self.pauseFunc is not None:
+                    self.pauses[name] = entry['pause']
+                if entry.get('paused'):
+                    self.paused.add(name)
+                self.__persist(name)
+        sysout('Restored timeouts for ' + str(len(entries)) + ' clients')
+
+    def flush(self):
+        """
+        Writes the exact current timeouts of all clients to the store
+        """
+        with self.lock:
+            for name in self.clients.keys():
+                self.__persist(name, True)
 
     def remove(self, name):
-        if name in self.clients:
-            del self.clients[name]
+        with self.lock:
+            if name in self.clients:
+                del self.clients[name]
+            self.pauses.pop(name, None)
+            self.paused.discard(name)
+            self.__persist(name)
+
+    def __persist(self, name, force=False):
+        if self.store is None:
+            return
+        if name not in self.clients:
+            if self.stored.pop(name, None) is not None:
+                self.store.remove(name)
+            return
+        entry = {'timeout': self.clients[name], 'pause': self.pauses.get(name), 'paused': name in self.paused}
+        last = self.stored.get(name)
+        if not force and last is not None and last['paused'] == entry['paused'] and \
+                self.__close(last['timeout'], entry['timeout']) and self.__close(last['pause'], entry['pause']):
+            return
+        self.store.put(name, entry)
+        self.stored[name] = entry
+
+    def __close(self, a, b):
+        if a is None or b is None:
+            return a is b
+        return abs(a - b) < self.storeSlack
+
+    def __setPause(self, name, pauseSeconds):
+        if self.pauseFunc is not None and pauseSeconds is not None:
+            self.pauses[name] = time() + pauseSeconds
+        else:
+            self.pauses.pop(name, None)
+
+    def __pause(self, name):
+        with self.lock:
+            due = self.pauses.get(name)
+            # the client may have been refreshed or removed in the meantime
+            if due is None or due >= time() or name in self.paused:
+                return
+        # pausing may wait for docker, do not block the other clients meanwhile
+        paused = self.pauseFunc(name)
+        if paused is None:
+            return
+        with self.lock:
+            refreshed = self.pauses.get(name) != due
+            if not refreshed:
+                if paused:
+                    self.paused.add(name)
+                    self.__persist(name)
+                    sysout('Paused ' + name)
+                else:
+                    # do not retry on each check if the client could not be paused
+                    del self.pauses[name]
+                return
+            resume = paused and name in self.clients
+        # the client was refreshed while it was paused
+        if resume:
+            self.__resume(name)
+
+    def __resume(self, name):
+        # resuming may wait for docker, do not block the other clients meanwhile
+        if self.resumeFunc(name):
+            sysout('Resumed ' + name)
+            return
+        with self.lock:
+            # the client stays paused, the next resetTimeout tries again
+            if name in self.clients:
+                self.paused.add(name)
+                self.__persist(name)
+        sysout('Could not resume ' + name)
+
+    def __timeout(self, name):
+        if self.callbackFunc(name) is False:
+            return False
+        self.remove(name)
+        return True
 
     def __watchdog(self):
         while True:
             currenttime = time()
             for name, timeleft in self.clients.copy().iteritems():
-                if timeleft < currenttime:
-                    self.callbackFunc(name)
-                    self.remove(name)
-                    sysout('Timeout reached for ' + name)
+                try:
+                    if timeleft < currenttime:
+                        if self.__timeout(name):
+                            sysout('Timeout reached for ' + name)
+                    elif self.pauses.get(name, currenttime) < currenttime and name not in self.paused:
+                        self.__pause(name)
+                except Exception, e:
+                    sysout("Error in TimeoutManager for " + name + ": " + str(e))
+            if self.pressureFunc is not None:
+                for name in sorted(self.paused.copy(), key=lambda n: self.clients.get(n, 0)):
+                    try:
+                        if self.pressureFunc(name) and self.__timeout(name):
+                            sysout('Memory pressure, timed out ' + name + ' early')
+                            break
+                    except Exception, e:
+                        sysout("Error in TimeoutManager for " + name + ": " + str(e))
             sleep(self.interval)
@@ -0,0 +1,198 @@
+"""
+Resumable large file transfers through the large file transfer container. Initialize with
+TransferManager(filemanager, directory) and copy with transfer(container, sourcefile, targetfile, user).
+
+Each transfer is tracked as a job, identified by data container, source and target. The job records the size,
+modification time and md5 sum of each source file and how many bytes of it have been copied, and is saved to a JSON file
+in the given directory after each batch of chunks. If a transfer is interrupted, calling transfer again with the same
+arguments resumes from the recorded offsets, as long as the source files did not change. Each copied file is verified
+against the md5 sum of its source, and the job is removed when all files have been copied and verified.
+"""
+
+import hashlib
+import json
+import os
+import traceback
+
+from lifecyclecoordinator import LifecycleCoordinator
+from filemanager import CHUNK_BLOCK_SIZE, transfer_timeout
+from utils import sysout
+
+# Files are copied in chunks of TRANSFER_CHUNK bytes, with up to TRANSFER_BATCH bytes per helper container
+TRANSFER_CHUNK = 64 * CHUNK_BLOCK_SIZE
+TRANSFER_BATCH = 512 * CHUNK_BLOCK_SIZE
+
+
+class TransferManager(object):
+    def __init__(self, filemanager, directory):
+        self.filemanager = filemanager
+        self.directory = directory
+        self.__jobs = LifecycleCoordinator()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def job_id(container, sourcefile, targetfile):
+        # the RPC passes unicode, which sha1 only accepts as ASCII
+        key = u'\0'.join([container, sourcefile, targetfile])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def transfer(self, container, sourcefile, targetfile, user=0):
+        """
+        Copies the given source to the given target, or resumes the interrupted transfer between them. Concurrent
+        calls for the same transfer share one run.
+        :param container: datacontainer to mount
+        :param sourcefile: file or directory to copy
+        :param targetfile: file or directory to copy to
+        :param user: UID or user name to use for copying
+        :return: the status of the job (see status) with the number of copied_bytes in this run
+        """
+        job_id = self.job_id(container, sourcefile, targetfile)
+        return self.__jobs.run(job_id, ('transfer',), self.__transfer, job_id, container, sourcefile, targetfile,
+                               user)
+
+    def status(self, container, job_id):
+        """
+        Returns the status of an unfinished job of the given data container, or None if there is no such job.
+        """
+        job = self.__load(job_id)
+        if job is None or job['container'] != container:
+            return None
+        return self.__status(job)
+
+    def cancel(self, container, job_id):
+        """
+        Forgets the unfinished job of the given data container, the next transfer starts from the beginning.
+        """
+        job = self.__load(job_id)
+        if job is not None and job['container'] == container:
+            os.remove(self.__path(job_id))
+
+    def __transfer(self, job_id, container, sourcefile, targetfile, user):
+        job = self.__load(job_id)
+        resumed = job is not None
+        if job is None:
+            job = {'id': job_id, 'container': container, 'source': sourcefile, 'target': targetfile, 'files': {}}
+        files = job['files']
+
+        # raises if the source does not exist, an empty source would report the job as complete
+        source, target = self.filemanager.manifest_with_lft(container, sourcefile, targetfile, user)
+        if len(source) == 0:
+            raise Exception('No files to transfer in ' + sourcefile)
+        for path in files.keys():
+            if path not in source:
+                del files[path]
+        for path, entry in source.iteritems():
+            record = files.get(path)
+            if record is None or record['size'] != entry['size'] or record['mtime'] != entry['mtime']:
+                record = files[path] = {'size': entry['size'], 'mtime': entry['mtime'], 'md5': None, 'copied': 0,
+                                        'complete': False, 'verified': False}
+            # The target may have been changed or removed since the last run
+            copied = target[path]['size'] if path in target else 0
+            if record['copied'] > copied or (record['complete'] and path not in target):
+                record.update(copied=copied - copied % TRANSFER_CHUNK, complete=False, verified=False)
+        self.__save(job)
+
+        missing = [path for path, record in files.iteritems() if record['md5'] is None]
+        if len(missing) > 0:
+            timeout = transfer_timeout(max(files[path]['size'] for path in missing))
+            for path, md5 in self.filemanager.checksum_with_lft(container, sourcefile, missing, user,
+                                                                timeout).iteritems():
+                files[path]['md5'] = md5
+            self.__save(job)
+
+        failed = set(path for path, record in files.iteritems() if record['md5'] is None)
+        copied_bytes = 0
+        batch = []
+        batch_bytes = 0
+        for path in sorted(files):
+            record = files[path]
+            if record['complete'] or path in failed:
+                continue
+            offset = record['copied']
+            while path not in failed:
+                length = min(TRANSFER_CHUNK, record['size'] - offset)
+                last = offset + length >= record['size']
+                batch.append((path, offset, length, last))
+                batch_bytes += length
+                if batch_bytes >= TRANSFER_BATCH:
+                    copied_bytes += self.__copy(job, batch, failed, user)
+                    batch = []
+                    batch_bytes = 0
+                if last:
+                    break
+                offset += length
+        if len(batch) > 0:
+            copied_bytes += self.__copy(job, batch, failed, user)
+
+        unverified = [path for path, record in files.iteritems() if record['complete'] and not record['verified']]
+        if len(unverified) > 0:
+            timeout = transfer_timeout(max(files[path]['size'] for path in unverified))
+            checksums = self.filemanager.checksum_with_lft(container, targetfile, unverified, user, timeout)
+            for path in unverified:
+                record = files[path]
+                if checksums.get(path) == record['md5']:
+                    record['verified'] = True
+                else:
+                    sysout('Checksum mismatch in transfer ' + job_id + ' for ' + path)
+                    record.update(copied=0, complete=False)
+                    failed.add(path)
+            self.__save(job)
+
+        status = self.__status(job)
+        status.update(resumed=resumed, copied_bytes=copied_bytes, failed=sorted(failed))
+        if status['complete']:
+            os.remove(self.__path(job_id))
+        return status
+
+    def __copy(self, job, chunks, failed, user):
+        files = job['files']
+        timeout = transfer_timeout(TRANSFER_CHUNK)
+        try:
+            copied = self.filemanager.copy_chunks_with_lft(job['container'], job['source'], job['target'], chunks,
+                                                           user, timeout)
+        except Exception, e:
+            sysout("Error in transfer " + job['id'] + ": " + str(e))
+            traceback.print_exc()
+            copied = []
+        copied_bytes = 0
+        lengths = dict(((path, offset), (length, last)) for path, offset, length, last in chunks)
+        for path, offset in copied:
+            record = files[path]
+            # chunks are only counted in order, a failed chunk is copied again by the next run
+            if offset != record['copied'] or record['complete']:
+                continue
+            length, last = lengths[(path, offset)]
+            record['copied'] = offset + length
+            record['complete'] = last
+            copied_bytes += length
+        copied = set(copied)
+        failed.update(path for path, offset, length, last in chunks if (path, offset) not in copied)
+        self.__save(job)
+        return copied_bytes
+
+    @staticmethod
+    def __status(job):
+        files = job['files'].values()
+        return {'job': job['id'],
+                'complete': all(record['verified'] for record in files),
+                'files': len(files),
+                'bytes': sum(record['size'] for record in files),
+                'transferred_bytes': sum(record['copied'] for record in files),
+                'checksums': dict((path, record['md5']) for path, record in job['files'].iteritems())}
+
+    def __path(self, job_id):
+        return os.path.join(self.directory, job_id + '.json')
+
+    def __load(self, job_id):
+        try:
+            with open(self.__path(job_id)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def __save(self, job):
+        path = self.__path(job['id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.rename(path + '.tmp', path)
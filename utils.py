@@ -2,10 +2,16 @@
 Holds some utility methods for dockerbridge
 """
 __author__ = 'mhorst@cs.uni-bremen.de'
+import os
 import sys
+import Queue
+from threading import Thread
 
 out = sys.stdout
 
+# Directory for state that has to survive restarts of the bridge
+STATE_DIR = os.environ.get('DOCKERBRIDGE_STATE_DIR', '/var/lib/dockerbridge')
+
 
 def sysout(msg):
     """
@@ -14,4 +20,59 @@ def sysout(msg):
     """
     sys.stderr.write(msg + "\n")
     out.write(msg + "\n")
-    out.flush()
\ No newline at end of file
+    out.flush()
+
+
+def available_memory_ratio(meminfo='/proc/meminfo'):
+    """
+    Returns the fraction of the host memory that is still available for new processes.
+    :param meminfo: path of the meminfo file to parse
+    """
+    values = {}
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                values[key] = int(value.split()[0])
+    except (IOError, ValueError):
+        return 1.0
+    if 'MemAvailable' in values:
+        available = values['MemAvailable']
+    else:
+        # kernels before 3.14 do not report MemAvailable
+        available = values.get('MemFree', 0) + values.get('Buffers', 0) + values.get('Cached', 0)
+    return float(available) / values['MemTotal'] if values.get('MemTotal') else 1.0
+
+
+def run_parallel(func, items, parallelism=8):
+    """
+    Calls func for each of the given items, using at most parallelism threads at the same time.
+    :param func: function to call with each item as argument
+    :param items: iterable of hashable items
+    :param parallelism: maximum number of concurrent calls
+    :return: a dict mapping each item to the result of its call, or to the exception the call raised
+    """
+    items = list(items)
+    results = {}
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[item] = func(item)
+            except Exception, e:
+                results[item] = e
+
+    threads = [Thread(target=worker) for _ in range(min(parallelism, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results